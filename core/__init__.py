@@ -1,4 +1,5 @@
 from core.errors import error_collector
 from core import lexer
+from core import preproc
 
-__all__ = ['error_collector', 'lexer']
+__all__ = ['error_collector', 'lexer', 'preproc']
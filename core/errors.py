@@ -1,22 +1,52 @@
 
+import re
+from bisect import bisect_right
+from contextlib import contextmanager
+from contextvars import ContextVar
+
 class ErrorCollector:
+    """Collects issues, sorting them by position only when they are read.
+
+    `error_count` counts the issues that are errors rather than warnings.
+
+    """
 
     def __init__(self):
-        self.issues = []
+        self.clear()
+
+    @property
+    def issues(self):
+        if not self._sorted:
+            self._issues.sort()
+            self._sorted = True
+        return self._issues
 
     def add(self, issue):
-        self.issues.append(issue)
-        self.issues.sort()
+        self._issues.append(issue)
+        self._sorted = False
+        if not issue.warning:
+            self.error_count += 1
+
+    def remove(self, test):
+        """Remove and return the issues for which `test` is true."""
+        removed = [issue for issue in self._issues if test(issue)]
+        if removed:
+            self._issues = [issue for issue in self._issues
+                            if not test(issue)]
+            self.error_count -= sum(not issue.warning for issue in removed)
+        return removed
 
     def ok(self):
-        return not any(not issue.warning for issue in self.issues)
+        return not self.error_count
 
     def show(self):
         for issue in self.issues:
             print(issue)
 
     def clear(self):
-        self.issues = []
+        self._issues = []
+        self._sorted = True
+        self.error_count = 0
 
 
 class Position:
@@ -32,7 +62,33 @@ class Position:
 
 
 
-error_collector = ErrorCollector()
+class CurrentCollector:
+    """Stands for the ErrorCollector of the running thread or task.
+
+    Every attribute is looked up on the collector in `current_collector`.
+    Code that reports issues through `error_collector` therefore reports
+    them to whichever collector is current. A thread or task can collect
+    its own issues by running under `collecting`. Everything else shares
+    one process-wide collector.
+
+    """
+
+    def __getattr__(self, name):
+        return getattr(current_collector.get(), name)
+
+
+current_collector = ContextVar("current_collector", default=ErrorCollector())
+error_collector = CurrentCollector()
+
+
+@contextmanager
+def collecting(collector):
+    """Make `collector` the current ErrorCollector within the block."""
+    token = current_collector.set(collector)
+    try:
+        yield collector
+    finally:
+        current_collector.reset(token)
 
 class Range:
 
@@ -44,6 +100,76 @@ class Range:
         return Range(self.start, other.end)
 
 
+class Source:
+    """The text of one file, with a line-start table built on first use.
+
+    Tokens only keep offsets into `text`; a line, column and source line are
+    worked out from them when a diagnostic or a tool asks for a Position.
+    `text` may also be a run of lines from the middle of a file, in which
+    case `first_line` is the line number it starts at.
+
+    """
+
+    # The line boundaries recognized by str.splitlines, for str text and for
+    # ASCII byte text (bytes.splitlines only knows about \r and \n).
+    str_line_break = re.compile(
+        "\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+    bytes_line_break = re.compile(b"\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e]")
+
+    def __init__(self, filename, text, first_line=1):
+        self.filename = filename
+        self.text = text
+        self.first_line = first_line
+        self._line_starts = None
+
+        if isinstance(text, str):
+            self.line_break = self.str_line_break
+        else:
+            self.line_break = self.bytes_line_break
+
+    @property
+    def line_starts(self):
+        if self._line_starts is None:
+            self._line_starts = [0] + [
+                match.end() for match in self.line_break.finditer(self.text)]
+        return self._line_starts
+
+    def position(self, offset):
+        starts = self.line_starts
+        line = bisect_right(starts, offset) - 1
+        full_line = self.text[starts[line]:starts[line + 1]
+                              if line + 1 < len(starts) else None]
+        if not isinstance(full_line, str):
+            full_line = full_line.decode()
+        full_line = full_line.splitlines()[0] if full_line else ""
+        return Position(self.filename, line + self.first_line,
+                        offset - starts[line] + 1, full_line)
+
+
+class SourceRange:
+    """A Range held as inclusive offsets into a Source."""
+
+    __slots__ = ("source", "first", "last")
+
+    def __init__(self, source, first, last):
+        self.source = source
+        self.first = first
+        self.last = last
+
+    @property
+    def start(self):
+        return self.source.position(self.first)
+
+    @property
+    def end(self):
+        return self.source.position(self.last)
+
+    def __add__(self, other):
+        if isinstance(other, SourceRange) and other.source is self.source:
+            return SourceRange(self.source, self.first, other.last)
+        return Range(self.start, other.end)
+
+
 class CompilerError(Exception):
 
     def __init__(self, descrip, range=None, warning=False):
@@ -67,6 +193,11 @@ class CompilerError(Exception):
         if not self.range:
             return bool(other.range)
 
+        if (isinstance(self.range, SourceRange)
+              and isinstance(other.range, SourceRange)
+              and self.range.source is other.range.source):
+            return self.range.first < other.range.first
+
         if self.range.start.file != other.range.start.file:
             return False
 
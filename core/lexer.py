@@ -1,272 +1,790 @@
+import codecs
 import re
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
 
 from core import tokens as tks
-from core.errors import CompilerError, Position, Range, error_collector
+from core.errors import CompilerError, Source, SourceRange, error_collector
+
+class Line:
+    """A logical source line, scanned by integer offset into `text`.
+
+    `pieces` holds one (start, offset) entry per physical line joined into
+    this one: `start` is where that physical line's characters begin in
+    `text`, and `offset` is where they begin in the source file.
+
+    """
+
+    def __init__(self, text, source, offset):
+        self.text = text
+        self.source = source
+        self.pieces = [(0, offset)]
+        self._str_text = None
+
+    @property
+    def start(self):
+        """Offset in the source file of the line's first character."""
+        return self.pieces[0][1]
+
+    @property
+    def str_text(self):
+        """`text` as a str; the text of byte input is decoded on first use."""
+        if isinstance(self.text, str):
+            return self.text
+        if self._str_text is None:
+            self._str_text = self.text.decode()
+        return self._str_text
+
+    def offset(self, i):
+        if len(self.pieces) == 1:
+            start, offset = self.pieces[0]
+        else:
+            piece = bisect_right(self.pieces, (i, float("inf"))) - 1
+            start, offset = self.pieces[piece]
+        return offset + i - start
 
-class Tagged:
+    def range(self, start, end):
+        return SourceRange(self.source, self.offset(start), self.offset(end))
 
-    def __init__(self, c, p):
-        self.c = c
-        self.p = p
-        self.r = Range(p, p)
 
+def tokenize(code, filename, cache=None, recover=False, max_errors=None):
+    """Lex `code` into a TokenBuffer.
 
-def tokenize(code, filename):
-    
-    tokens = []
-    lines = split_to_tagged_lines(code, filename)
-    join_extended_lines(lines)
+    `code` is a str, or a bytes-like object such as bytes or an mmap of the
+    file. ASCII byte input is scanned in place, and only identifiers, numbers
+    and string literals are decoded, so a large file is never copied into a
+    str. Byte input with any non-ASCII byte is decoded as UTF-8 up front and
+    lexed as a str, so both paths give the same tokens.
 
-    in_comment = False
-    for line in lines:
-        try:
-            line_tokens, in_comment = tokenize_line(line, in_comment)
-            tokens += line_tokens
-        except CompilerError as e:
-            error_collector.add(e)
+    If a TokenCache is given, the tokens and errors of a source it has seen
+    before are loaded from it instead of lexed again.
 
-    return process(tokens)
+    Normally a line with a lexing error is dropped. With `recover`, the bad
+    text becomes an error token instead and the rest of the line is still
+    lexed. Lexing stops at the error that brings the number found to
+    `max_errors`, which must be at least 1.
 
+    """
+    if cache is not None:
+        return cache.tokenize(code, filename, recover, max_errors)
 
-def split_to_tagged_lines(text, filename):
-    
-    lines = text.splitlines()
-    tagged_lines = []
-    for line_num, line in enumerate(lines):
-        tagged_line = []
-        for col, char in enumerate(line):
-            p = Position(filename, line_num + 1, col + 1, line)
-            tagged_line.append(Tagged(char, p))
-        tagged_lines.append(tagged_line)
+    source = Source(filename, source_text(code))
+    tokens = tks.TokenBuffer(source)
+    tokenize_lines(logical_lines(source), tokens, recover=recover,
+                   max_errors=max_errors)
+    return tokens
 
-    return tagged_lines
 
+def source_text(code):
+    """Return the text `tokenize` lexes for `code`.
 
-def join_extended_lines(lines):
+    Byte input with any non-ASCII byte is decoded as UTF-8; anything else is
+    lexed as it is.
 
-    i = 0
-    while i < len(lines):
-        if lines[i] and lines[i][-1].c == "\\":
-            
-            if i + 1 < len(lines):
-                del lines[i][-1] 
-                lines[i] += lines[i + 1]  
-                del lines[i + 1]  
+    """
+    if not isinstance(code, str) and non_ascii.search(code):
+        return str(code, "utf-8")
+    return code
 
-                i -= 1
 
-            else:
-                del lines[i][-1]  
+def error_offsets(source):
+    """The errors collected for `source`, as plain offsets.
 
-        i += 1
+    Each is a (description, first, last, warning) tuple, which can be
+    pickled or stored and given back to `report_errors`.
 
+    """
+    return [(e.descrip, e.range.first, e.range.last, e.warning)
+            for e in error_collector.issues
+            if isinstance(e.range, SourceRange) and e.range.source is source]
 
-def tokenize_line(line, in_comment):
-    tokens = []
 
-    chunk_start = 0
-    chunk_end = 0
+def report_errors(errors, source, shift=0):
+    """Add errors from `error_offsets` to the error collector.
 
-    include_line = False
-   
-    seen_filename = False
-    while chunk_end < len(line):
-        symbol_kind = match_symbol_kind_at(line, chunk_end)
-        next_symbol_kind = match_symbol_kind_at(line, chunk_end + 1)
-       
-        if match_include_command(tokens):
-            include_line = True
+    Their offsets are moved by `shift` into `source`.
 
-        if in_comment:
-            
-            if (symbol_kind == tks.star and
-                    next_symbol_kind == tks.slash):
-                in_comment = False
-                chunk_start = chunk_end + 2
-                chunk_end = chunk_start
-            
-            else:
-                chunk_start = chunk_end + 1
-                chunk_end = chunk_start
-       
-        elif (symbol_kind == tks.slash and
-                next_symbol_kind == tks.star):
-            add_chunk(line[chunk_start:chunk_end], tokens)
-            in_comment = True
+    """
+    for descrip, first, last, warning in errors:
+        error_range = SourceRange(source, first + shift, last + shift)
+        error_collector.add(CompilerError(descrip, error_range, warning))
+
+
+def tokenize_stream(code, filename, chunk_size=65536):
+    """Yield the tokens of `code` lazily, one logical line at a time.
+
+    `code` is either a file object, in text or binary mode, which is read
+    `chunk_size` characters or bytes at a time, or any iterable of strings
+    or bytes whose concatenation is the source, such as the lines of a file
+    with their line endings kept. Bytes are decoded as UTF-8. Only the
+    logical line being lexed is held in memory, so the input can be of any
+    size. Comments and backslash-joined lines may span chunk boundaries.
+
+    """
+    if hasattr(code, "read"):
+        chunks = read_chunks(code, chunk_size)
+    else:
+        chunks = code
+
+    in_comment = False
+    for first_line, text in read_logical_lines(decode_chunks(chunks)):
+        source = Source(filename, text, first_line)
+        tokens = tks.TokenBuffer(source)
+
+        in_comment = tokenize_lines(logical_lines(source), tokens, in_comment)
+        yield from tokens
 
-        
-        elif (symbol_kind == tks.slash and
-                next_symbol_kind == tks.slash):
+
+def read_chunks(file, chunk_size):
+    """Yield chunks read from `file` until it is exhausted."""
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def decode_chunks(chunks):
+    """Yield `chunks` as strings, decoding bytes chunks as UTF-8.
+
+    A character whose bytes are split between chunks is yielded with the
+    chunk it ends in.
+
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in chunks:
+        if not isinstance(chunk, str):
+            chunk = decoder.decode(chunk)
+        yield chunk
+    decoder.decode(b"", final=True)
+
+
+def read_logical_lines(chunks):
+    """Regroup string chunks into runs of physical lines.
+
+    Yields (line number, text) for each run of lines joined by trailing
+    backslashes, keeping their line endings.
+
+    """
+    line_num = 1
+    group = []
+
+    for line in read_physical_lines(chunks):
+        group.append(line)
+        if not line.splitlines()[0].endswith("\\"):
+            yield line_num, "".join(group)
+            line_num += len(group)
+            group = []
+
+    if group:
+        yield line_num, "".join(group)
+
+
+def read_physical_lines(chunks):
+    """Yield the lines of string chunks, keeping their line endings.
+
+    The pieces of a line are kept in a list until its line break is seen,
+    so a line spanning many chunks is only joined once. A line ending in a
+    "\\r" at the end of a chunk is held back until the next chunk, as it
+    may be the first half of a "\\r\\n".
+
+    """
+    parts = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if parts and parts[-1].endswith("\r"):
+            if chunk.startswith("\n"):
+                parts.append("\n")
+                chunk = chunk[1:]
+            yield "".join(parts)
+            parts = []
+            if not chunk:
+                continue
+
+        lines = chunk.splitlines(keepends=True)
+        for line in lines[:-1]:
+            parts.append(line)
+            yield "".join(parts)
+            parts = []
+
+        parts.append(lines[-1])
+        if (Source.str_line_break.match(chunk, len(chunk) - 1)
+              and not chunk.endswith("\r")):
+            yield "".join(parts)
+            parts = []
+
+    if parts:
+        yield "".join(parts)
+
+
+def tokenize_parallel(code, filename, workers=None, shard_size=1 << 20):
+    """Lex `code` like `tokenize`, spreading the work over processes.
+
+    The source is cut at logical line starts into shards of about
+    `shard_size` characters, which a pool of `workers` processes lex at the
+    same time. Whether a shard starts inside a comment is not known until
+    the shards before it are lexed, so each is lexed both ways and the
+    results are stitched in order. Tokens, positions and errors are the
+    same as those of `tokenize`.
+
+    """
+    code = source_text(code)
+    source = Source(filename, code)
+    bounds = shard_bounds(source, shard_size)
+    if len(bounds) <= 2:
+        return tokenize(code, filename)
+
+    tokens = tks.TokenBuffer(source)
+    in_comment = False
+    with ProcessPoolExecutor(workers) as pool:
+        shards = (code[start:end] for start, end in zip(bounds, bounds[1:]))
+        for result in pool.map(tokenize_shard, shards, bounds):
+            state, errors, end_comment, comment_lex = result
+            first = 0
+            if in_comment:
+                prefix, prefix_errors, agree, end_comment = comment_lex
+                tokens.extend(tks.load_buffer(None, prefix))
+                report_errors(prefix_errors, source)
+                if agree is None:
+                    in_comment = end_comment
+                    continue
+                first, first_offset = agree
+                errors = [e for e in errors if e[1] >= first_offset]
+
+            tokens.extend(tks.load_buffer(None, state), first)
+            report_errors(errors, source)
+            in_comment = end_comment
+
+    return tokens
+
+
+def shard_bounds(source, shard_size):
+    """Offsets that cut `source` into logical lines of about `shard_size`.
+
+    The list starts at 0 and ends at the length of the text.
+
+    """
+    text = source.text
+    bounds = [0]
+    pos = shard_size - 1
+    while pos < len(text):
+        match = source.line_break.search(text, pos)
+        if not match:
             break
+        pos = match.end()
+        start = match.start()
+        # A search from inside a "\r\n" finds only its "\n".
+        if text[start:pos] in ("\n", b"\n") and text[start - 1:start] in (
+                "\r", b"\r"):
+            start -= 1
+        if not ends_with_backslash(text[start - 1:start]):
+            bounds.append(pos)
+            pos += shard_size - 1
+
+    if bounds[-1] < len(text):
+        bounds.append(len(text))
+    return bounds
+
+
+def tokenize_shard(text, base):
+    """Lex a shard for `tokenize_parallel`, both in and out of a comment.
+
+    The shard starts at offset `base` of the file, and every offset returned
+    is an offset into the file, so the results only need appending.
+
+    Returns the tokens, as `TokenBuffer.dump` output, the errors, as
+    `error_offsets` gives them, and the final comment state of the lex that
+    starts outside a comment, then a tuple describing the lex that starts in
+    one. The two lexes agree from the first line they start in the same
+    state, so the second is only run that far: its tuple holds the tokens
+    and errors before that line, the index of the line's first token and
+    the line's offset (or None if the lexes never agree), and its final
+    comment state.
+
+    """
+    error_collector.clear()
+    source = Source(None, text)
+    lines = list(logical_lines(source, base=base))
+
+    tokens = tks.TokenBuffer(source)
+    table = LineTable()
+    in_comment = tokenize_lines(lines, tokens, table=table)
+    errors = error_offsets(source)
+    end_comment = in_comment
+
+    error_collector.clear()
+    comment_tokens = tks.TokenBuffer(source)
+    agree = None
+    in_comment = True
+    for i, line in enumerate(lines):
+        if in_comment == table.comments[i]:
+            agree = (table.tokens[i], line.start)
+            in_comment = end_comment
+            break
+        in_comment = tokenize_or_report(line, in_comment, comment_tokens)
+
+    comment_lex = (comment_tokens.dump(), error_offsets(source), agree,
+                   in_comment)
+    error_collector.clear()
+    return tokens.dump(), errors, end_comment, comment_lex
+
+
+class LineTable:
+    """The lexer state at the start of each logical line of a source.
+
+    `starts` holds the offset each line starts at, `comments` whether it
+    starts inside a comment, and `tokens` the index of its first token.
+    `relex` uses these to tell where re-lexing after an edit can stop.
+    `starts` and `tokens` are OffsetArrays, so an edit leaves the entries
+    of the lines after it in place.
+
+    """
+
+    def __init__(self):
+        self.starts = tks.OffsetArray()
+        self.comments = bytearray()
+        self.tokens = tks.OffsetArray()
+
+    def append(self, start, in_comment, token):
+        self.starts.append(start)
+        self.comments.append(in_comment)
+        self.tokens.append(token)
+
+    def splice(self, start, stop, other, shift, token_base, token_shift):
+        """Replace lines [start, stop) with the lines of table `other`.
+
+        `other`'s token indexes are moved by `token_base`; the offsets and
+        token indexes of the lines after the replaced ones are moved by
+        `shift` and `token_shift`.
+
+        """
+        self.starts.splice(start, stop, other.starts.values, shift)
+        self.comments[start:stop] = other.comments
+        self.tokens.splice(start, stop,
+                           map(token_base.__add__, other.tokens.values),
+                           token_shift)
+
+
+def tokenize_incremental(code, filename):
+    """Lex `code` like `tokenize`, also returning its LineTable for `relex`."""
+    source = Source(filename, code)
+    tokens = tks.TokenBuffer(source)
+    table = LineTable()
+    tokenize_lines(logical_lines(source), tokens, table=table)
+    return tokens, table
+
+
+def relex(tokens, table, offset, removed, inserted):
+    """Apply an edit to a lexed source, re-lexing only the lines it affects.
+
+    The edit replaces `removed` characters at `offset` with `inserted`.
+    `tokens` and `table` come from `tokenize_incremental` (or an earlier
+    `relex`) and are updated in place. Lexing starts at the line before the
+    edit, in case the edit changes how that line ends, and stops at the
+    first line past the edit that started a line in the old source with the
+    same comment state: from there on the old tokens are still right, and
+    are only moved to their new offsets. The collected errors of the old
+    source are moved to the new one the same way, except that those of the
+    re-lexed lines are replaced by the errors found re-lexing them.
+
+    Returns the range of token indexes that were re-lexed.
+
+    """
+    old_source = tokens.source
+    text = (old_source.text[:offset] + inserted
+            + old_source.text[offset + removed:])
+    source = Source(old_source.filename, text)
+    shift = len(inserted) - removed
+    edit_end = offset + len(inserted)
+
+    old_errors = error_offsets(old_source)
+    error_collector.remove(lambda e: isinstance(e.range, SourceRange)
+                           and e.range.source is old_source)
+
+    first = max(table.starts.bisect_right(offset) - 2, 0)
+    if first < len(table.starts):
+        start, in_comment = table.starts[first], table.comments[first]
+    else:
+        start, in_comment = 0, False
+
+    new_tokens = tks.TokenBuffer(source)
+    new_table = LineTable()
+    stop = len(table.starts)
+
+    for line in logical_lines(source, start):
+        if line.start >= edit_end:
+            old_start = line.start - shift
+            old = table.starts.bisect_left(old_start, first)
+            if (old < len(table.starts) and table.starts[old] == old_start
+                  and table.comments[old] == in_comment):
+                stop = old
+                break
 
-        
-        elif line[chunk_end].c.isspace():
-            add_chunk(line[chunk_start:chunk_end], tokens)
-            chunk_start = chunk_end + 1
-            chunk_end = chunk_start
+        new_table.append(line.start, in_comment, len(new_tokens))
+        in_comment = tokenize_or_report(line, in_comment, new_tokens)
 
-        
-        elif symbol_kind in {tks.dquote, tks.squote}:
-            quote_str = '"'
-            kind = tks.string
-            add_null = True
+    cut = table.tokens[first] if first < len(table.starts) else len(tokens)
+    keep = table.tokens[stop] if stop < len(table.starts) else len(tokens)
 
-            chars, end = read_string(line, chunk_end + 1, quote_str, add_null)
-            rep = chunk_to_str(line[chunk_end:end + 1])
-            r = Range(line[chunk_end].p, line[end].p)
+    report_errors([e for e in old_errors if e[1] < start], source)
+    if stop < len(table.starts):
+        report_errors([e for e in old_errors if e[1] >= table.starts[stop]],
+                      source, shift)
 
-            tokens.append(tks.Token(kind, chars, rep, r=r))
+    tokens.splice(cut, keep, new_tokens, shift)
+    table.splice(first, stop, new_table, shift,
+                 cut, len(new_tokens) - (keep - cut))
+    return cut, cut + len(new_tokens)
 
-            chunk_start = end + 1
-            chunk_end = chunk_start
 
-        elif symbol_kind:
-            symbol_start_index = chunk_end
-            symbol_end_index = chunk_end + len(symbol_kind.text_repr) - 1
+def tokenize_lines(lines, tokens, in_comment=False, table=None,
+                   recover=False, max_errors=None):
+    """Lex logical lines into `tokens`, returning the final comment state.
 
-            r = Range(line[symbol_start_index].p, line[symbol_end_index].p)
-            symbol_token = tks.Token(symbol_kind, r=r)
+    If a LineTable is given, the state at the start of each line is
+    recorded in it. If `max_errors` is given, lexing stops at the error
+    that brings the number this call has found to it.
 
-            add_chunk(line[chunk_start:chunk_end], tokens)
-            tokens.append(symbol_token)
+    """
+    limit = None
+    if max_errors is not None:
+        if max_errors < 1:
+            raise ValueError("max_errors must be at least 1")
+        limit = error_collector.error_count + max_errors
 
-            chunk_start = chunk_end + len(symbol_kind.text_repr)
-            chunk_end = chunk_start
+    try:
+        for line in lines:
+            if table is not None:
+                table.append(line.start, in_comment, len(tokens))
+            in_comment = tokenize_or_report(line, in_comment, tokens,
+                                            recover, limit)
+    except ErrorLimit:
+        descrip = "too many errors, lexing stopped"
+        error_collector.add(CompilerError(descrip, line.range(0, 0)))
 
-        else:
-            chunk_end += 1
+    return in_comment
 
-    add_chunk(line[chunk_start:chunk_end], tokens)
-    return tokens, in_comment
 
-def chunk_to_str(chunk):
-    return "".join(c.c for c in chunk)
+class ErrorLimit(Exception):
+    """Raised when the lexer has found as many errors as it may."""
 
-def match_symbol_kind_at(content, start):
-    for symbol_kind in tks.symbol_kinds:
-        try:
-            for i, c in enumerate(symbol_kind.text_repr):
-                if content[start + i].c != c:
-                    break
-            else:
-                return symbol_kind
-        except IndexError:
-            pass
 
-    return None
+def check_error_limit(limit):
+    """Raise ErrorLimit if the error collector has `limit` errors."""
+    if limit is not None and error_collector.error_count >= limit:
+        raise ErrorLimit
+
+
+def tokenize_or_report(line, in_comment, tokens, recover=False,
+                       limit=None):
+    """Lex one logical line, adding any error to the error collector.
+
+    A line with a lexing error contributes no tokens, unless `recover` is
+    set; see `bad_token`. ErrorLimit is raised once the collector has
+    `limit` errors, keeping the tokens lexed so far.
+
+    """
+    line_start = len(tokens)
+    try:
+        return tokenize_line(line, in_comment, tokens, recover, limit)
+    except CompilerError as e:
+        tokens.truncate(line_start)
+        error_collector.add(e)
+        check_error_limit(limit)
+        return in_comment
+
 
+def logical_lines(source, start=0, base=0):
+    """Yield the logical lines of `source` from offset `start` on.
 
-def match_include_command(tokens):
-    return (len(tokens) == 2 and
-            tokens[-1].kind == tks.identifier)
+    `start` must be the start of a logical line. Backslash continuations are
+    joined. The lines give offsets moved by `base`, for when `source` is a
+    piece of a file that starts at offset `base`.
 
+    """
+    run = []
+    for line in split_to_lines(source, start, base):
+        run.append(line)
+        if not ends_with_backslash(line.text):
+            yield join_extended_lines(run)
+            run = []
 
-def read_string(line, start, delim, null):
+    if run:
+        yield join_extended_lines(run)
 
-    i = start
-    chars = []
 
-    escapes = {"'": 39,
-               '"': 34,
-               "?": 63,
-               "\\": 92,
-               "a": 7,
-               "b": 8,
-               "f": 12,
-               "n": 10,
-               "r": 13,
-               "t": 9,
-               "v": 11}
-    octdigits = "01234567"
-    hexdigits = "0123456789abcdefABCDEF"
+def split_to_lines(source, start=0, base=0):
+    """Yield the physical lines of `source` without their line endings."""
+    text = source.text
+    for match in source.line_break.finditer(text, start):
+        yield Line(text[start:match.start()], source, base + start)
+        start = match.end()
+
+    if start < len(text):
+        yield Line(text[start:], source, base + start)
+
+
+def ends_with_backslash(text):
+    return text[-1:] in ("\\", b"\\")
+
+
+def join_extended_lines(lines):
+    """Join a run of physical lines continued by backslashes into one Line.
+
+    Every line of the run but the last ends in a backslash, which is dropped,
+    as is a backslash left at the end of the joined text. The text is joined
+    in a single pass, and the new Line's `pieces` map each part of it back to
+    the physical line it came from.
+
+    """
+    if len(lines) == 1 and not ends_with_backslash(lines[0].text):
+        return lines[0]
+
+    parts = []
+    pieces = []
+    length = 0
+    for line in lines[:-1]:
+        pieces.append((length, line.start))
+        parts.append(line.text[:-1])
+        length += len(line.text) - 1
+    pieces.append((length, lines[-1].start))
+    parts.append(lines[-1].text)
+
+    text = lines[0].text[:0].join(parts)
+    if ends_with_backslash(text):
+        text = text[:-1]
+
+    joined = Line(text, lines[0].source, lines[0].start)
+    joined.pieces = pieces
+    return joined
+
+
+def make_scanner(for_bytes=False):
+    """Compile the master regex that recognizes every lexeme of a line.
+
+    Alternatives are tried in order, so comments and string literals win over
+    the symbols they start with, and longer symbols win over shorter ones.
+    Keywords, numbers and identifiers must run up to whitespace, a symbol or
+    the end of line; anything else is left to `add_chunk` in one piece.
+
+    With `for_bytes`, the regex scans ASCII bytes, spelling out the
+    characters str.isspace accepts since \\s on bytes misses some of them.
+
+    """
+    def alternation(kinds):
+        kinds = sorted(kinds, key=lambda kind: -len(kind.text_repr))
+        return "|".join(re.escape(kind.text_repr) for kind in kinds)
+
+    symbols = alternation(tks.symbol_kinds)
+    keywords = alternation(tks.keyword_kinds)
+    space, non_space = r"\s", r"\S"
+    if for_bytes:
+        space, non_space = r"[\t-\r\x1c-\x1f ]", r"[^\t-\r\x1c-\x1f ]"
+    end = rf"(?={space}|{symbols}|\Z)"
+
+    pattern = rf"""
+        (?P<line_comment>//)
+      | (?P<comment>/\*)
+      | (?P<space>{space}+)
+      | (?P<string>["'](?:[^"\\]|\\.)*")
+      | (?P<quote>["'])
+      | (?P<symbol>{symbols})
+      | (?P<keyword>(?:{keywords}){end})
+      | (?P<number>[0-9]+{end})
+      | (?P<identifier>[_a-zA-Z][_a-zA-Z0-9]*{end})
+      | (?P<chunk>(?:(?!{symbols}){non_space})+)
+    """
+
+    if for_bytes:
+        pattern = pattern.encode()
+    return re.compile(pattern, re.VERBOSE)
+
+
+scanner = make_scanner()
+byte_scanner = make_scanner(for_bytes=True)
+non_ascii = re.compile(rb"[^\x00-\x7f]")
+header_name = re.compile(r'[ \t]*(<[^>]*>|"[^"]*")')
+byte_header_name = re.compile(header_name.pattern.encode())
+identifier_name = re.compile(r"[_a-zA-Z][_a-zA-Z0-9]*")
+string_escape = re.compile(
+    rb"\\(?:(['\"?\\abfnrtv])|([0-7]{1,3})|x([0-9a-fA-F]+))")
+simple_escapes = {b"'": b"'", b'"': b'"', b"?": b"?", b"\\": b"\\",
+                  b"a": b"\a", b"b": b"\b", b"f": b"\f", b"n": b"\n",
+                  b"r": b"\r", b"t": b"\t", b"v": b"\v"}
+
+# Keyed by both str and bytes text, so either scanner's matches look up here.
+symbol_kinds = {kind.text_repr: kind for kind in tks.symbol_kinds}
+symbol_kinds.update({text.encode(): kind
+                     for text, kind in symbol_kinds.items()})
+keyword_kinds = {kind.text_repr: kind for kind in tks.keyword_kinds}
+keyword_kinds.update({text.encode(): kind
+                      for text, kind in keyword_kinds.items()})
+
+
+def tokenize_line(line, in_comment, tokens, recover=False, limit=None):
+    text = line.text
+    first = len(tokens)
+    pos = 0
+
+    if isinstance(text, str):
+        match_at, as_str, comment_end = scanner.match, str, "*/"
+        header_at = header_name.match
+    else:
+        match_at, as_str, comment_end = byte_scanner.match, bytes.decode, b"*/"
+        header_at = byte_header_name.match
+
+    include_line = False
 
     while True:
-        if i >= len(line):
+        if in_comment:
+            pos = text.find(comment_end, pos)
+            if pos == -1:
+                return True
+            in_comment = False
+            pos += 2
+
+        match = match_at(text, pos)
+        if not match:
+            break
+
+        if not include_line and match_include_command(tokens, first):
+            include_line = True
+            header = header_at(text, pos)
+            if header:
+                start, pos = header.span(1)
+                tokens.append(tks.include_file, line.offset(start),
+                              line.offset(pos - 1), as_str(header.group(1)))
+                continue
+
+        group = match.lastgroup
+        start, pos = match.span()
+
+        if group == "space":
+            continue
+
+        elif group == "identifier":
+            tokens.append(tks.identifier, line.offset(start),
+                          line.offset(pos - 1), sys.intern(as_str(match.group())))
+
+        elif group == "symbol":
+            tokens.append(symbol_kinds[match.group()], line.offset(start),
+                          line.offset(pos - 1))
+
+        elif group == "keyword":
+            tokens.append(keyword_kinds[match.group()], line.offset(start),
+                          line.offset(pos - 1))
+
+        elif group == "number":
+            tokens.append(tks.number, line.offset(start),
+                          line.offset(pos - 1), as_str(match.group()))
+
+        elif group == "string":
+            chars = read_string(line, start, pos)
+            if chars is None:
+                descrip = "escape sequence out of range"
+                bad_token(descrip, line, start, pos, tokens, recover, limit)
+            else:
+                tokens.append(tks.string, line.offset(start),
+                              line.offset(pos - 1), chars,
+                              as_str(match.group()))
+
+        elif group == "quote":
+            # The literal cannot be closed on this line, so the rest of the
+            # line is one error token rather than code.
+            if recover:
+                pos = len(text.rstrip())
             descrip = "missing terminating quote"
-            raise CompilerError(descrip, line[start - 1].r)
-        elif line[i].c == delim:
-            if null: chars.append(0)
-            return chars, i
-        elif (i + 1 < len(line)
-              and line[i].c == "\\"
-              and line[i + 1].c in escapes):
-            chars.append(escapes[line[i + 1].c])
-            i += 2
-        elif (i + 1 < len(line)
-              and line[i].c == "\\"
-              and line[i + 1].c in octdigits):
-            octal = line[i + 1].c
-            i += 2
-            while (i < len(line)
-                   and len(octal) < 3
-                   and line[i].c in octdigits):
-                octal += line[i].c
-                i += 1
-            chars.append(int(octal, 8))
-        elif (i + 2 < len(line)
-              and line[i].c == "\\"
-              and line[i + 1].c == "x"
-              and line[i + 2].c in hexdigits):
-            hexa = line[i + 2].c
-            i += 3
-            while i < len(line) and line[i].c in hexdigits:
-                hexa += line[i].c
-                i += 1
-            chars.append(int(hexa, 16))
+            bad_token(descrip, line, start, pos, tokens, recover, limit)
+
+        elif group == "comment":
+            # The closing "*/" is searched for from the opening "/", as the
+            # character-by-character scanner this replaced used to do.
+            in_comment = True
+            pos = start
+
+        elif group == "line_comment":
+            break
+
         else:
-            chars.append(ord(line[i].c))
-            i += 1
+            add_chunk(line, start, pos, tokens, recover, limit)
 
-def add_chunk(chunk, tokens):
-    if chunk:
-        range = Range(chunk[0].p, chunk[-1].p)
+    return in_comment
 
-        keyword_kind = match_keyword_kind(chunk)
-        if keyword_kind:
-            tokens.append(tks.Token(keyword_kind, r=range))
-            return
 
-        number_string = match_number_string(chunk)
-        if number_string:
-            tokens.append(tks.Token(tks.number, number_string, r=range))
-            return
+def bad_token(descrip, line, start, end, tokens, recover, limit=None):
+    """Report [start, end) of `line` as a lexing error.
 
-        identifier_name = match_identifier_name(chunk)
-        if identifier_name:
-            tokens.append(tks.Token(
-                tks.identifier, identifier_name, r=range))
-            return
+    Without `recover` the error is raised, and the caller drops the line.
+    With it, the error is collected and the text becomes an error token;
+    lexing goes on from `end`, which is at whitespace, a symbol or the end
+    of a string literal, unless the error reaches `limit`.
+
+    """
+    error = CompilerError(descrip, line.range(start, end - 1))
+    if not recover:
+        raise error
 
-        descrip = f"unrecognized token at '{chunk_to_str(chunk)}'"
-        raise CompilerError(descrip, range)
+    error_collector.add(error)
+    tokens.append(tks.error, line.offset(start), line.offset(end - 1),
+                  line.str_text[start:end])
+    check_error_limit(limit)
 
 
-def match_keyword_kind(token_repr):
-    token_str = chunk_to_str(token_repr)
-    for keyword_kind in tks.keyword_kinds:
-        if keyword_kind.text_repr == token_str:
-            return keyword_kind
-    return None
+def match_include_command(tokens, first):
+    """Check if the tokens of the line so far are "#include"."""
+    return (len(tokens) - first == 2
+            and tokens.kinds[-2] == tks.pound.id
+            and tokens.kinds[-1] == tks.identifier.id
+            and tokens.content(len(tokens) - 1) == "include")
 
 
-def match_number_string(token_repr):
-    token_str = chunk_to_str(token_repr)
-    return token_str if token_str.isdigit() else None
+def read_string(line, start, end):
+    """Decode the string literal at [start, end) of `line` to bytes.
 
+    The result includes the null terminator. Escape sequences are rewritten
+    by one precompiled regex, so a literal costs a single allocation however
+    long it is; other characters are kept as their UTF-8 encoding. Returns
+    None if an escape sequence does not fit in a byte.
 
-def match_identifier_name(token_repr):
-    token_str = chunk_to_str(token_repr)
-    if re.match(r"[_a-zA-Z][_a-zA-Z0-9]*$", token_str):
-        return token_str
+    """
+    chars = line.text[start + 1:end - 1]
+    if isinstance(chars, str):
+        chars = chars.encode()
+
+    if b"\\" in chars:
+        try:
+            chars = string_escape.sub(unescape, chars)
+        except ValueError:
+            return None
+
+    return chars + b"\0"
+
+
+def unescape(match):
+    simple, octal, hexa = match.groups()
+    if simple:
+        return simple_escapes[simple]
+    elif octal:
+        return bytes((int(octal, 8),))
     else:
-        return None
+        return bytes((int(hexa, 16),))
 
-def process(tokens):
 
-    processed = []
-    i = 0
-    while i < len(tokens) - 2:
-        processed.append(tokens[i])
-        i += 1
+def add_chunk(line, start, end, tokens, recover=False, limit=None):
+    if start < end:
+        token_str = line.str_text[start:end]
+        first, last = line.offset(start), line.offset(end - 1)
 
-    return processed + tokens[i:]
+        keyword_kind = keyword_kinds.get(token_str)
+        if keyword_kind:
+            tokens.append(keyword_kind, first, last)
+        elif token_str.isdigit():
+            tokens.append(tks.number, first, last, token_str)
+        elif identifier_name.fullmatch(token_str):
+            tokens.append(tks.identifier, first, last, sys.intern(token_str))
+        else:
+            descrip = f"unrecognized token at '{token_str}'"
+            bad_token(descrip, line, start, end, tokens, recover, limit)
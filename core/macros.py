@@ -0,0 +1,315 @@
+from core import tokens as tks
+from core.errors import CompilerError, SourceRange, error_collector
+
+# Tokens being expanded are tuples of (kind id, content, rep, where,
+# painted). `where` is (source, start, end) for a token with a place in a
+# source, or (None, i, j) in a cached expansion for token j of argument i.
+# A painted identifier named a macro while that macro was being expanded,
+# so it is never expanded again.
+KIND, CONTENT, REP, WHERE, PAINTED = range(5)
+
+
+class Macro:
+    """A #define: `params` is None for an object-like macro."""
+
+    def __init__(self, name, params, body):
+        self.name = name
+        self.params = params
+        self.body = body
+
+
+class MacroExpander:
+    """Expands macros, caching each expansion for reuse.
+
+    An expansion is cached by the macro, the kind and content of its
+    argument tokens, and the macros being expanded around it. The cached
+    tokens refer to argument tokens by position, so a later call with the
+    same argument text reuses the expansion but keeps its own token
+    positions.
+
+    Each cached expansion keeps the names looked up while building it,
+    including those of the expansions nested in it and names that were
+    not macros then. `dependents` maps each name to the cached keys that
+    looked it up, so defining or undefining a macro drops only those.
+
+    `hits` and `misses` count lookups of that cache, and `max_depth` is the
+    deepest nesting of expansions built.
+
+    """
+
+    def __init__(self):
+        self.macros = {}
+        self.cache = {}
+        self.dependents = {}
+        self.consulted = []
+
+        self.hits = 0
+        self.misses = 0
+        self.depth = 0
+        self.max_depth = 0
+
+    def __contains__(self, name):
+        return name in self.macros
+
+    def define(self, macro):
+        old = self.macros.get(macro.name)
+        if (old is None or old.params != macro.params
+              or body_key(old.body) != body_key(macro.body)):
+            self.macros[macro.name] = macro
+            self.invalidate(macro.name)
+
+    def undefine(self, name):
+        if self.macros.pop(name, None) is not None:
+            self.invalidate(name)
+
+    def invalidate(self, name):
+        """Drop the cached expansions that looked up `name`."""
+        for key in self.dependents.pop(name, ()):
+            _, names = self.cache.pop(key)
+            for other in names - {name}:
+                keys = self.dependents[other]
+                keys.discard(key)
+                if not keys:
+                    del self.dependents[other]
+
+    def expand_at(self, tokens, i, stop):
+        """Expand the macro named by token `i` of a buffer.
+
+        Arguments are read from tokens before `stop`. Returns the expanded
+        tokens and the index of the first token after the invocation. An
+        expansion ending in the name of a function-like macro is rescanned
+        together with the tokens after it, which may hold its arguments.
+
+        """
+        head = source_token(tokens, i)
+        i += 1
+        result = []
+
+        while True:
+            macro = self.macros[head[CONTENT]]
+            args = None
+            if macro.params is not None:
+                end = closing_paren(tokens, i, stop)
+                if end is None:
+                    result.append(head)
+                    return result, i
+                invocation = [source_token(tokens, j) for j in range(i, end)]
+                args, _ = collect_args(invocation, 0)
+                i = end
+
+            expansion = self.expand(macro, head, args, frozenset())
+            if (i < stop and tokens.kinds[i] == tks.l_paren.id
+                  and self.is_function_name(expansion[-1:])):
+                result += expansion[:-1]
+                head = expansion[-1]
+            else:
+                return result + expansion, i
+
+    def expand(self, macro, head, args, disabled):
+        """Return the tokens of one fully rescanned macro invocation."""
+        if args is not None and not self.check_args(macro, head, args):
+            return [head[:PAINTED] + (True,)]
+
+        args = args or []
+        key = (macro.name, tuple(args_key(arg) for arg in args), disabled)
+        entry = self.cache.get(key)
+        if entry is None:
+            self.misses += 1
+            placeholders = [[token[:WHERE] + ((None, i, j), token[PAINTED])
+                             for j, token in enumerate(arg)]
+                            for i, arg in enumerate(args)]
+
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self.consulted.append({macro.name})
+            template = self.build(macro, placeholders, disabled)
+            names = self.consulted.pop()
+            self.depth -= 1
+
+            self.cache[key] = template, names
+            for name in names:
+                self.dependents.setdefault(name, set()).add(key)
+        else:
+            self.hits += 1
+            template, names = entry
+
+        # The expansion being built around this one depends on the same names.
+        if self.consulted:
+            self.consulted[-1] |= names
+        return instantiate(template, args)
+
+    def build(self, macro, args, disabled):
+        """Substitute `args` into the body of `macro`, then rescan it."""
+        if macro.params is None:
+            replaced = macro.body
+        else:
+            params = {name: i for i, name in enumerate(macro.params)}
+            expanded = {}
+            replaced = []
+            for token in macro.body:
+                param = (params.get(token[CONTENT])
+                         if token[KIND] == tks.identifier.id else None)
+                if param is None:
+                    replaced.append(token)
+                    continue
+                if param not in expanded:
+                    expanded[param] = self.rescan(args[param], disabled)
+                replaced += expanded[param]
+
+        return self.rescan(replaced, disabled | {macro.name})
+
+    def rescan(self, tokens, disabled):
+        """Expand every macro invocation in a list of tokens."""
+        tokens = list(tokens)
+        result = []
+        i = 0
+        while i < len(tokens):
+            head = tokens[i]
+            i += 1
+            macro = self.invoked(head)
+            if macro is None:
+                result.append(head)
+                continue
+            if macro.name in disabled:
+                result.append(head[:PAINTED] + (True,))
+                continue
+
+            args = None
+            if macro.params is not None:
+                args, i = collect_args(tokens, i)
+                if args is None:
+                    result.append(head)
+                    continue
+
+            expansion = self.expand(macro, head, args, disabled)
+            if (i < len(tokens) and tokens[i][KIND] == tks.l_paren.id
+                  and self.is_function_name(expansion[-1:])):
+                i -= 1
+                tokens[i] = expansion[-1]
+                expansion = expansion[:-1]
+            result += expansion
+
+        return result
+
+    def invoked(self, token):
+        """Return the macro `token` names if it may be expanded, or None.
+
+        While an expansion is being built, the name is recorded as looked
+        up by it, whether or not it is a macro.
+
+        """
+        if token[KIND] != tks.identifier.id or token[PAINTED]:
+            return None
+        if self.consulted:
+            self.consulted[-1].add(token[CONTENT])
+        return self.macros.get(token[CONTENT])
+
+    def is_function_name(self, tokens):
+        if not tokens:
+            return False
+        macro = self.invoked(tokens[0])
+        return macro is not None and macro.params is not None
+
+    def check_args(self, macro, head, args):
+        if len(macro.params) == 0 and args == [[]]:
+            args.clear()
+        if len(args) == len(macro.params):
+            return True
+
+        descrip = (f"macro '{macro.name}' requires {len(macro.params)} "
+                   f"arguments, but {len(args)} given")
+        error_collector.add(CompilerError(descrip, token_range(head)))
+        return False
+
+
+def source_token(tokens, i):
+    """Return token `i` of a single-source buffer as an expansion token."""
+    return (tokens.kinds[i], tokens.content(i), tokens.rep(i),
+            (tokens.source, tokens.starts[i], tokens.ends[i]), False)
+
+
+def closing_paren(tokens, i, stop):
+    """Return the index after the parenthesis closing the one at `i`.
+
+    Returns None if token `i` is not "(" or it is not closed before `stop`.
+
+    """
+    kinds = tokens.kinds
+    if i >= stop or kinds[i] != tks.l_paren.id:
+        return None
+
+    depth = 0
+    for j in range(i, stop):
+        if kinds[j] == tks.l_paren.id:
+            depth += 1
+        elif kinds[j] == tks.r_paren.id:
+            depth -= 1
+            if depth == 0:
+                return j + 1
+    return None
+
+
+def collect_args(tokens, i):
+    """Split the parenthesized arguments at `tokens[i]` on their commas.
+
+    Returns the list of arguments and the index after the closing
+    parenthesis, or None and `i` if there is no complete argument list.
+
+    """
+    if i >= len(tokens) or tokens[i][KIND] != tks.l_paren.id:
+        return None, i
+
+    args = [[]]
+    depth = 0
+    for j in range(i + 1, len(tokens)):
+        kind = tokens[j][KIND]
+        if kind == tks.r_paren.id and depth == 0:
+            return args, j + 1
+        elif kind == tks.comma.id and depth == 0:
+            args.append([])
+            continue
+        elif kind == tks.l_paren.id:
+            depth += 1
+        elif kind == tks.r_paren.id:
+            depth -= 1
+        args[-1].append(tokens[j])
+
+    return None, i
+
+
+def append_tokens(out, tokens):
+    """Append expansion tokens to the buffer `out`."""
+    for kind, content, rep, (source, start, end), _ in tokens:
+        base = out.source_base(source)
+        out.append(tks.all_kinds[kind], base + start, base + end, content,
+                   rep)
+
+
+def instantiate(template, args):
+    """Put the tokens of `args` in place of a cached expansion's references."""
+    if not args:
+        return template
+
+    result = []
+    for token in template:
+        source, i, j = token[WHERE]
+        if source is None:
+            token = args[i][j][:WHERE] + (args[i][j][WHERE], token[PAINTED])
+        result.append(token)
+    return result
+
+
+def args_key(tokens):
+    return tuple((token[KIND], token[CONTENT], token[PAINTED])
+                 for token in tokens)
+
+
+def body_key(tokens):
+    return tuple((token[KIND], token[CONTENT]) for token in tokens)
+
+
+def token_range(token):
+    source, start, end = token[WHERE]
+    if source is None:
+        return None
+    return SourceRange(source, start, end)
@@ -6,21 +6,67 @@ import core.tree.decl_nodes as decl_nodes
 import core.tree.nodes as nodes
 from core.parser.expression import parse_expression
 from core.parser.utils import (add_range, ParserError, match_token, token_is,
-                                 raise_error, log_error, token_in)
+                                 raise_error, log_error, token_in,
+                                 matching_brace)
 
 
 @add_range
 def parse_func_definition(index):
+    """Parse a function definition.
+
+    The parameters are declared in a scope of their own around the body,
+    so a parameter hides a typedef of the same name inside it.
+
+    """
     specs, index = parse_decl_specifiers(index)
     decl, index = parse_declarator(index)
+    func = find_function(decl)
+    if func is None:
+        raise_error("expected function declarator", index, ParserError.AT)
+
+    p.symbols.new_scope()
+    for arg in func.args:
+        name = declared_name(arg.decls[0])
+        if name:
+            p.symbols.add_symbol(name, False)
 
     from core.parser.statement import parse_compound_statement
-    body, index = parse_compound_statement(index)
+    end = None
+    if p.lazy_bodies and token_is(index, tks.l_brack):
+        end = matching_brace(index)
+
+    # A body that is not closed is parsed now, to report the error.
+    if end is None:
+        body, index = parse_compound_statement(index)
+    else:
+        parse_body = p.current_parser.get().defer(parse_compound_statement,
+                                                  index)
+        body = nodes.LazyCompound(parse_body)
+        body.set_span(p.tokens, index, end + 1)
+        index = end + 1
 
+    p.symbols.end_scope()
     root = decl_nodes.Root(specs, [decl])
     return nodes.Declaration(root, body), index
 
 
+def find_function(decl):
+    """Return the Function node declaring the name in `decl`, or None."""
+    func = None
+    while not isinstance(decl, decl_nodes.Identifier):
+        if isinstance(decl, decl_nodes.Function):
+            func = decl
+        decl = decl.child
+    return func
+
+
+def declared_name(decl):
+    """Return the name `decl` declares, or None if it is abstract."""
+    while not isinstance(decl, decl_nodes.Identifier):
+        decl = decl.child
+    return decl.identifier.content if decl.identifier else None
+
+
 @add_range
 def parse_declaration(index):
     node, index = parse_decls_inits(index)
@@ -38,9 +84,74 @@ def parse_abstract_declarator(index):
         error_collector.add(CompilerError(err, node.identifier.r))
 
     return root, index
+
+
 @add_range
-def parse_decls_inits(index, parse_inits=True):
+def parse_declarator(index):
+    """Parse a declarator, declaring its name in the current scope.
+
+    Pointers are parsed around the direct declarator, and each array or
+    parameter list suffix around the part before it. An abstract
+    declarator, with no name, ends in an Identifier of None.
+
+    """
+    stars = 0
+    while token_is(index, tks.star):
+        stars += 1
+        index += 1
+
+    if token_is(index, tks.identifier):
+        identifier = p.tokens[index]
+        p.symbols.add_symbol(identifier.content, False)
+        node = decl_nodes.Identifier(identifier)
+        index += 1
+    else:
+        node = decl_nodes.Identifier(None)
+
+    while True:
+        if token_is(index, tks.l_sq_brack):
+            n = None
+            if not token_is(index + 1, tks.r_sq_brack):
+                n, index = parse_expression(index + 1)
+            else:
+                index += 1
+            index = match_token(index, tks.r_sq_brack, ParserError.GOT)
+            node = decl_nodes.Array(n, node)
+        elif token_is(index, tks.l_paren):
+            args, index = parse_parameter_list(index + 1)
+            node = decl_nodes.Function(args, node)
+        else:
+            break
+
+    for _ in range(stars):
+        node = decl_nodes.Pointer(node, False)
+    return node, index
+
+
+def parse_parameter_list(index):
+    """Parse the parameters after a "(", and the ")" closing them.
+
+    The parameter names are declared in a scope that ends with the list.
+
+    """
+    args = []
+    p.symbols.new_scope()
+    if not token_is(index, tks.r_paren):
+        while True:
+            specs, index = parse_decl_specifiers(index)
+            decl, index = parse_declarator(index)
+            args.append(decl_nodes.Root(specs, [decl]))
+            if not token_is(index, tks.comma):
+                break
+            index += 1
+    p.symbols.end_scope()
+    index = match_token(index, tks.r_paren, ParserError.GOT)
+    return args, index
+
 
+@add_range
+def parse_decls_inits(index, parse_inits=True):
+    specs, index = parse_decl_specifiers(index)
     if token_is(index, tks.semicolon):
         return decl_nodes.Root(specs, []), index + 1
 
@@ -48,9 +159,8 @@ def parse_decls_inits(index, parse_inits=True):
     inits = []
 
     while True:
-        # node, index = parse_declarator(index, is_typedef)
-        # print(node)
-        # decls.append(node)
+        node, index = parse_declarator(index)
+        decls.append(node)
 
         if token_is(index, tks.equals) and parse_inits:
             from core.parser.expression import parse_assignment
@@ -59,7 +169,6 @@ def parse_decls_inits(index, parse_inits=True):
         else:
             inits.append(None)
 
-        print(inits)
         if token_is(index, tks.comma):
             index += 1
         else:
@@ -69,13 +178,14 @@ def parse_decls_inits(index, parse_inits=True):
     node = decl_nodes.Root(specs, decls, inits)
     return node, index
 
-def parse_decl_specifiers(index, _spec_qual=False):
-    type_specs = set(ctypes.simple_types.keys())
+type_specs = tks.KindTable(ctypes.simple_types.keys())
 
-    type_quals = {}
+type_quals = tks.KindTable()
 
-    storage_specs = {}
+storage_specs = tks.KindTable()
 
+
+def parse_decl_specifiers(index, _spec_qual=False):
     specs = []
 
     SIMPLE = 1
@@ -86,7 +196,7 @@ def parse_decl_specifiers(index, _spec_qual=False):
     while True:
         if (not type_spec_class
               and token_is(index, tks.identifier)
-              and p.symbols.is_typedef(p.tokens[index])):
+              and p.symbols.is_typedef(p.tokens.content(index))):
             specs.append(p.tokens[index])
             index += 1
             type_spec_class = TYPEDEF
@@ -5,200 +5,261 @@ import core.parser.utils as p
 import core.tree.expr_nodes as expr_nodes
 import core.tree.decl_nodes as decl_nodes
 from core.parser.utils import (add_range, match_token, token_is, ParserError,
-                                 raise_error, log_error, token_in)
+                                 raise_error, log_error)
 
-@add_range
-def parse_expression(index):
-    return parse_series(
-        index, parse_assignment,
-        {tks.comma: expr_nodes.MultiExpr})
+# Binding power of each binary operator level, loosest first. A
+# conditional expression is a logical-or expression, as there is no "?:".
+COMMA, ASSIGNMENT, LOGICAL_OR, LOGICAL_AND, EQUALITY, RELATIONAL, BITWISE, \
+    ADDITIVE, MULTIPLICATIVE = range(1, 10)
+CONDITIONAL = LOGICAL_OR
 
-@add_range
-def parse_assignment(index):
 
-    left, index = parse_conditional(index)
+def parse_expression(index):
+    return parse_binary(index, COMMA)
 
-    if index < len(p.tokens):
-        op = p.tokens[index]
-        kind = op.kind
-    else:
-        op = None
-        kind = None
 
-    node_types = {tks.equals: expr_nodes.Equals}
+def parse_assignment(index):
+    return parse_binary(index, ASSIGNMENT)
 
-    if kind in node_types:
-        right, index = parse_assignment(index + 1)
-        return node_types[kind](left, right, op), index
-    else:
-        return left, index
 
-@add_range
 def parse_conditional(index):
-    return parse_logical_or(index)
-
-@add_range
-def parse_logical_or(index):
-    return parse_series(
-        index, parse_logical_and,
-        {})
-
-@add_range
-def parse_logical_and(index):
-    return parse_series(
-        index, parse_equality,
-        {})
-
-@add_range
-def parse_equality(index):
-    return parse_series(
-        index, parse_relational,
-        {})
-
-@add_range
-def parse_relational(index):
-    return parse_series(
-        index, parse_bitwise,
-        {})
-
-
-@add_range
-def parse_bitwise(index):
-    return parse_series(
-        index, parse_additive,
-        {})
+    return parse_binary(index, CONDITIONAL)
 
 
-@add_range
-def parse_additive(index):
-    return parse_series(
-        index, parse_multiplicative,
-        {tks.plus: expr_nodes.Plus,
-         tks.minus: expr_nodes.Minus})
-
+# The frames parse_binary keeps on its stack. Each stands for a call of a
+# recursive descent parser that is waiting for a subexpression:
+#   [BINARY, start, min_level, cur, cur_level, pending operator or None]
+#   (CAST, start, decl_node) and (UNARY, start, node_type), for prefixes
+#   (PAREN, start), (SUBSCRIPT, start, head) and (CALL, start, func, args)
+BINARY, CAST, UNARY, PAREN, SUBSCRIPT, CALL = range(6)
 
-@add_range
-def parse_multiplicative(index):
-    return parse_series(
-        index, parse_cast,
-        {tks.star: expr_nodes.Mult,
-         tks.slash: expr_nodes.Div,
-         tks.mod: expr_nodes.Mod})
+# What parse_binary does next: read an operand, apply postfix operators to
+# `node`, finish the cast expression `node`, look for a binary operator
+# after the top frame's operand, or hand `node` to the frame below.
+OPERAND, POSTFIX, CAST_DONE, OPERATOR, BINARY_DONE = range(5)
 
 
 @add_range
-def parse_cast(index):
-    from core.parser.declaration import (
-        parse_abstract_declarator, parse_spec_qual_list)
-
-    with log_error():
-        match_token(index, tks.l_paren, ParserError.AT)
-        specs, index = parse_spec_qual_list(index + 1)
-        node, index = parse_abstract_declarator(index)
-        match_token(index, tks.r_paren, ParserError.AT)
-
-        decl_node = decl_nodes.Root(specs, [node])
-        expr_node, index = parse_cast(index + 1)
-        return expr_nodes.Cast(decl_node, expr_node), index
-
-    return parse_unary(index)
+def parse_binary(index, min_level):
+    """Parse operands joined by binary operators of at least `min_level`.
 
+    Operators are read from `binary_ops` by precedence climbing, so each
+    operand is parsed once however many levels there are. Operators of a
+    level group to the left, except assignment, which groups to the right.
 
-@add_range
-def parse_unary(index):
-    unary_args = {tks.amp: (parse_cast, expr_nodes.AddrOf),
-                  tks.star: (parse_cast, expr_nodes.Deref),
-                  tks.plus: (parse_cast, expr_nodes.UnaryPlus),
-                  tks.minus: (parse_cast, expr_nodes.UnaryMinus)}
-
-    if token_in(index, unary_args):
-        parse_func, NodeClass = unary_args[p.tokens[index].kind]
-        subnode, index = parse_func(index + 1)
-        return NodeClass(subnode), index
-    else:
-        return parse_postfix(index)
+    Nested expressions are parsed with an explicit stack of frames rather
+    than by recursion, so parentheses, prefix operators, assignments and
+    call arguments can nest as deep as memory allows. The trees and ranges
+    are those of a parser with one function per level: a node gets a range
+    wherever such a function would have returned it.
 
+    """
+    tokens = p.tokens
+    kinds = tokens.kinds
+    end = len(tokens)
+    l_paren = tks.l_paren.id
 
-@add_range
-def parse_postfix(index):
-    cur, index = parse_primary(index)
+    stack = [[BINARY, index, min_level, None, None, None]]
+    state = OPERAND
 
     while True:
-        old_range = cur.r
+        if state == OPERAND:
+            start = index
+            while index < end:
+                if kinds[index] == l_paren:
+                    cast = parse_cast_prefix(index)
+                    if cast is None:
+                        break
+                    decl_node, index = cast
+                    stack.append((CAST, start, decl_node))
+                else:
+                    node_type = unary_ops.lookup(kinds[index])
+                    if node_type is None:
+                        break
+                    stack.append((UNARY, start, node_type))
+                    index += 1
+                start = index
 
-        if token_is(index, tks.l_sq_brack):
-            index += 1
-            arg, index = parse_expression(index)
-            cur = expr_nodes.ArraySubsc(cur, arg)
-            match_token(index, tks.close_sq_brack, ParserError.GOT)
-            index += 1
+            if index < end and kinds[index] == l_paren:
+                stack.append((PAREN, start))
+                stack.append([BINARY, index + 1, COMMA, None, None, None])
+                index += 1
+            else:
+                node, index = parse_primary(index)
+                node.set_span(tokens, start, index)
+                state = POSTFIX
+
+        elif state == POSTFIX:
+            kind = kinds[index] if index < end else None
+            if kind == tks.l_sq_brack.id:
+                stack.append((SUBSCRIPT, start, node))
+                stack.append([BINARY, index + 1, COMMA, None, None, None])
+                index += 1
+                state = OPERAND
+
+            elif kind == tks.dot.id:
+                index += 1
+                match_token(index, tks.identifier, ParserError.AFTER)
+                member = tokens[index]
+
+                if token_is(index - 1, tks.dot):
+                    node = expr_nodes.ObjMember(node, member)
+                else:
+                    node = expr_nodes.ObjPtrMember(node, member)
 
-        elif (token_is(index, tks.dot)):
-            index += 1
-            match_token(index, tks.identifier, ParserError.AFTER)
-            member = p.tokens[index]
+                index += 1
+                node.set_span(tokens, start, index)
 
-            if token_is(index - 1, tks.dot):
-                cur = expr_nodes.ObjMember(cur, member)
-            else:
-                cur = expr_nodes.ObjPtrMember(cur, member)
+            elif kind == l_paren:
+                index += 1
+                if token_is(index, tks.r_paren):
+                    node = expr_nodes.FuncCall(node, [])
+                    index += 1
+                    state = CAST_DONE
+                else:
+                    stack.append((CALL, start, node, []))
+                    stack.append([BINARY, index, ASSIGNMENT, None, None,
+                                  None])
+                    state = OPERAND
 
+            else:
+                state = CAST_DONE
+
+        elif state == CAST_DONE:
+            node.set_span(tokens, start, index)
+            frame = stack[-1]
+            if frame[0] == CAST:
+                stack.pop()
+                node = expr_nodes.Cast(frame[2], node)
+                start = frame[1]
+            elif frame[0] == UNARY:
+                stack.pop()
+                node = frame[2](node)
+                start = frame[1]
+            else:
+                give_operand(frame, node)
+                state = OPERATOR
+
+        elif state == OPERATOR:
+            frame = stack[-1]
+            _, frame_start, frame_min, cur, cur_level, _ = frame
+            op = binary_ops.lookup(kinds[index]) if index < end else None
+            if not op or op[0] < frame_min:
+                stack.pop()
+                node = cur
+                node.set_span(tokens, frame_start, index)
+                state = BINARY_DONE
+                continue
+
+            level, node_type = op
+            if cur_level is not None and level != cur_level:
+                cur.set_span(tokens, frame_start, index)
+
+            frame[5] = (level, node_type, tokens[index])
             index += 1
+            if level == ASSIGNMENT:
+                stack.append([BINARY, index, ASSIGNMENT, None, None, None])
+            elif level != MULTIPLICATIVE:
+                stack.append([BINARY, index, level + 1, None, None, None])
+            state = OPERAND
+
+        elif state == BINARY_DONE:
+            if not stack:
+                return node, index
+
+            frame = stack[-1]
+            if frame[0] == BINARY:
+                give_operand(frame, node)
+                state = OPERATOR
+
+            elif frame[0] == PAREN:
+                stack.pop()
+                index = match_token(index, tks.r_paren, ParserError.GOT)
+                node = expr_nodes.ParenExpr(node)
+                start = frame[1]
+                node.set_span(tokens, start, index)
+                state = POSTFIX
+
+            elif frame[0] == SUBSCRIPT:
+                stack.pop()
+                node = expr_nodes.ArraySubsc(frame[2], node)
+                match_token(index, tks.close_sq_brack, ParserError.GOT)
+                index += 1
+                start = frame[1]
+                node.set_span(tokens, start, index)
+                state = POSTFIX
+
+            elif frame[0] == CALL:
+                frame[3].append(node)
+                if token_is(index, tks.comma):
+                    index += 1
+                    stack.append([BINARY, index, ASSIGNMENT, None, None,
+                                  None])
+                    state = OPERAND
+                else:
+                    stack.pop()
+                    index = match_token(index, tks.r_paren, ParserError.GOT)
+                    node = expr_nodes.FuncCall(frame[2], frame[3])
+                    start = frame[1]
+                    state = CAST_DONE
 
-        elif token_is(index, tks.l_paren):
-            args = []
-            index += 1
 
-            if token_is(index, tks.r_paren):
-                return expr_nodes.FuncCall(cur, args), index + 1
+def give_operand(frame, node):
+    """Give a BINARY frame its first operand, or the right operand it wants."""
+    if frame[5] is None:
+        frame[3] = node
+    else:
+        level, node_type, tok = frame[5]
+        frame[3] = node_type(frame[3], node, tok)
+        frame[4] = level
+        frame[5] = None
 
-            while True:
-                arg, index = parse_assignment(index)
-                args.append(arg)
 
-                if token_is(index, tks.comma):
-                    index += 1
-                else:
-                    break
+def parse_cast_prefix(index):
+    """Parse the "(type-name)" of a cast at `index`.
 
-            index = match_token(
-                index, tks.r_paren, ParserError.GOT)
+    Returns the declaration node of the type and the index after the ")",
+    or None if there is no type name there.
 
-            return expr_nodes.FuncCall(cur, args), index
+    """
+    from core.parser.declaration import (
+        parse_abstract_declarator, parse_spec_qual_list)
 
-        else:
-            return cur, index
+    with log_error():
+        specs, index = parse_spec_qual_list(index + 1)
+        node, index = parse_abstract_declarator(index)
+        match_token(index, tks.r_paren, ParserError.AT)
+        return decl_nodes.Root(specs, [node]), index + 1
 
-        cur.r = old_range + p.tokens[index - 1].r
+    return None
 
 
-@add_range
 def parse_primary(index):
-    if token_is(index, tks.l_paren):
-        node, index = parse_expression(index + 1)
-        index = match_token(index, tks.r_paren, ParserError.GOT)
-        return expr_nodes.ParenExpr(node), index
-    elif token_is(index, tks.number):
-        return expr_nodes.Number(p.tokens[index]), index + 1
-    elif (token_is(index, tks.identifier)
-          and not p.symbols.is_typedef(p.tokens[index])):
-        return expr_nodes.Identifier(p.tokens[index]), index + 1
-    elif token_is(index, tks.string):
-        return expr_nodes.String(p.tokens[index].content), index + 1
+    """Parse a primary expression other than a parenthesized one."""
+    tokens = p.tokens
+    kind = tokens.kinds[index] if index < len(tokens) else None
+    if kind == tks.number.id:
+        return expr_nodes.Number(tokens[index]), index + 1
+    elif (kind == tks.identifier.id
+          and not p.symbols.is_typedef(tokens.content(index))):
+        return expr_nodes.Identifier(tokens[index]), index + 1
+    elif kind == tks.string.id:
+        return expr_nodes.String(tokens[index].content), index + 1
     else:
         raise_error("expected expression", index, ParserError.GOT)
 
 
-def parse_series(index, parse_base, separators):
-
-    cur, index = parse_base(index)
-    while True:
-        for s in separators:
-            if token_is(index, s):
-                break
-        else:
-            return cur, index
-
-        tok = p.tokens[index]
-        new, index = parse_base(index + 1)
-        cur = separators[s](cur, new, tok)
+# Dispatch tables from operator token kinds to the node each one builds.
+binary_ops = tks.KindTable({
+    tks.comma: (COMMA, expr_nodes.MultiExpr),
+    tks.equals: (ASSIGNMENT, expr_nodes.Equals),
+    tks.plus: (ADDITIVE, expr_nodes.Plus),
+    tks.minus: (ADDITIVE, expr_nodes.Minus),
+    tks.star: (MULTIPLICATIVE, expr_nodes.Mult),
+    tks.slash: (MULTIPLICATIVE, expr_nodes.Div),
+    tks.mod: (MULTIPLICATIVE, expr_nodes.Mod),
+})
+unary_ops = tks.KindTable({tks.amp: expr_nodes.AddrOf,
+                           tks.star: expr_nodes.Deref,
+                           tks.plus: expr_nodes.UnaryPlus,
+                           tks.minus: expr_nodes.UnaryMinus})
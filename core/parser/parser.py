@@ -1,26 +1,116 @@
 import core.parser.utils as p
 import core.tree.nodes as nodes
 
-from core.errors import error_collector
+from core.errors import collecting, current_collector
 from core.parser.utils import (add_range, log_error, ParserError,
                                  raise_error)
 from core.parser.expression import parse_assignment
+from core.parser.declaration import parse_func_definition
 
-def parse(tokens_to_parse):
-    p.best_error = None
-    p.tokens = tokens_to_parse
 
-    with log_error():
-        return parse_root(0)[0]
+class Parser:
+    """The state of parsing one token buffer.
 
-    error_collector.add(p.best_error)
-    return None
+    Each Parser has its own symbol table, best error and packrat memo, and
+    reports to its own ErrorCollector, `errors`. That collector defaults to
+    the one current when the Parser is made. While `parse` runs, the
+    Parser is current in its thread or task, so parse functions reach its
+    state through `core.parser.utils`. Separate Parsers can run at once
+    in different threads or tasks.
+
+    With `lazy_bodies`, function bodies are skipped by matching braces and
+    left as LazyCompound nodes, which parse them when their items are
+    first read.
+
+    """
+
+    def __init__(self, tokens, packrat=False, errors=None,
+                 lazy_bodies=False, typedefs=(), scopes=()):
+        self.tokens = tokens
+        self.symbols = p.SimpleSymbolTable(typedefs, scopes)
+        self.best_error = None
+        self.packrat = packrat
+        self.lazy_bodies = lazy_bodies
+        self.memo = {}
+        self.errors = current_collector.get() if errors is None else errors
+
+    def parse(self):
+        """Parse the token buffer into a Root node, or None on error.
+
+        On error the best ParserError found is added to `errors`.
+
+        """
+        return self.run(parse_root, 0)
+
+    def run(self, parse_func, index):
+        """Return the node `parse_func` parses at `index`, or None on error.
+
+        The parse as a whole is not speculative, so unlike `log_error` no
+        checkpoint is held for it, and the symbol table only records changes
+        while a speculative parse inside it is running.
+
+        """
+        token = p.current_parser.set(self)
+        try:
+            with collecting(self.errors):
+                try:
+                    return parse_func(index)[0]
+                except ParserError as e:
+                    self.note_error(e)
+
+                self.errors.add(self.best_error)
+                return None
+        finally:
+            p.current_parser.reset(token)
+            self.memo.clear()
+
+    def note_error(self, error):
+        """Keep `error` as the best error if it parsed at least as far."""
+        best_error = self.best_error
+        if not best_error or error.amount_parsed >= best_error.amount_parsed:
+            self.best_error = error
+
+    def defer(self, parse_func, index):
+        """Return a function that runs `parse_func` at `index` when called.
+
+        It parses with a new Parser over the same tokens, which sees the
+        scopes open now as they are now: the file scope typedefs declared
+        so far but none declared later, and the scopes inside it, such as
+        that of a function's parameters.
+
+        """
+        mark = len(self.symbols.file_typedefs)
+        scopes = self.symbols.inner_scopes()
+
+        def parse_deferred():
+            typedefs = self.symbols.file_typedefs_at(mark)
+            parser = Parser(self.tokens, self.packrat, self.errors,
+                            typedefs=typedefs, scopes=scopes)
+            return parser.run(parse_func, index)
+
+        return parse_deferred
+
+
+def parse(tokens_to_parse, packrat=False, lazy_bodies=False):
+    """Parse a token buffer into a Root node, or return None on error.
+
+    With `packrat`, the result of each parse function at each token index
+    is remembered, so backtracking never parses the same input twice. With
+    `lazy_bodies`, function bodies are only parsed when first read.
+
+    """
+    return Parser(tokens_to_parse, packrat, lazy_bodies=lazy_bodies).parse()
 
 
 @add_range
 def parse_root(index):
     items = []
     while True:
+        with log_error():
+            node, index = parse_func_definition(index)
+            items.append(node)
+            continue
+
         with log_error():
             expr, index = parse_assignment(index + 1)
             items.append(expr)
@@ -28,7 +118,7 @@ def parse_root(index):
 
         break
 
-    if not p.tokens[index:]:
+    if index >= len(p.tokens):
         return nodes.Root(items), index
     else:
         raise_error("unexpected token", index, ParserError.AT)
@@ -1,28 +1,26 @@
 """Parser logic that parses statement nodes."""
 
-import core.token_kinds as token_kinds
+from core import tokens as tks
 import core.tree.nodes as nodes
 import core.parser.utils as p
 
 from core.parser.declaration import parse_declaration
 from core.parser.expression import parse_expression
 from core.parser.utils import (add_range, log_error, match_token, token_is,
-                                 ParserError)
+                                 token_in, ParserError)
 
 
 @add_range
 def parse_statement(index):
     """Parse a statement.
 
-    Try each possible type of statement, catching/logging exceptions upon
-    parse failures. On the last try, raise the exception on to the caller.
+    The first token decides which kind of statement to parse, through
+    `statement_parsers`; a statement not starting with one of its tokens is
+    an expression statement.
 
     """
-    for func in (parse_compound_statement, parse_return, parse_break,
-                 parse_continue, parse_if_statement, parse_while_statement,
-                 parse_for_statement):
-        with log_error():
-            return func(index)
+    if token_in(index, statement_parsers):
+        return statement_parsers.lookup(p.tokens.kinds[index])(index)
 
     return parse_expr_statement(index)
 
@@ -36,16 +34,23 @@ def parse_compound_statement(index):
 
     """
     p.symbols.new_scope()
-    index = match_token(index, token_kinds.open_brack, ParserError.GOT)
+    index = match_token(index, tks.l_brack, ParserError.GOT)
 
     # Read block items (statements/declarations) until there are no more.
+    # Only an expression statement and a declaration can start with the
+    # same token, so only those two are tried in turn.
     items = []
     while True:
-        with log_error():
+        if token_in(index, statement_parsers):
             item, index = parse_statement(index)
             items.append(item)
             continue
 
+        with log_error():
+            item, index = parse_expr_statement(index)
+            items.append(item)
+            continue
+
         with log_error():
             item, index = parse_declaration(index)
             items.append(item)
@@ -53,7 +58,7 @@ def parse_compound_statement(index):
 
         break
 
-    index = match_token(index, token_kinds.close_brack, ParserError.GOT)
+    index = match_token(index, tks.r_brack, ParserError.GOT)
     p.symbols.end_scope()
 
     return nodes.Compound(items), index
@@ -66,29 +71,29 @@ def parse_return(index):
     Ex: return 5;
 
     """
-    index = match_token(index, token_kinds.return_kw, ParserError.GOT)
-    if token_is(index, token_kinds.semicolon):
+    index = match_token(index, tks.return_kw, ParserError.GOT)
+    if token_is(index, tks.semicolon):
         return nodes.Return(None), index
 
     node, index = parse_expression(index)
 
-    index = match_token(index, token_kinds.semicolon, ParserError.AFTER)
+    index = match_token(index, tks.semicolon, ParserError.AFTER)
     return nodes.Return(node), index
 
 
 @add_range
 def parse_break(index):
     """Parse a break statement."""
-    index = match_token(index, token_kinds.break_kw, ParserError.GOT)
-    index = match_token(index, token_kinds.semicolon, ParserError.AFTER)
+    index = match_token(index, tks.break_kw, ParserError.GOT)
+    index = match_token(index, tks.semicolon, ParserError.AFTER)
     return nodes.Break(), index
 
 
 @add_range
 def parse_continue(index):
     """Parse a continue statement."""
-    index = match_token(index, token_kinds.continue_kw, ParserError.GOT)
-    index = match_token(index, token_kinds.semicolon, ParserError.AFTER)
+    index = match_token(index, tks.continue_kw, ParserError.GOT)
+    index = match_token(index, tks.semicolon, ParserError.AFTER)
     return nodes.Continue(), index
 
 
@@ -96,18 +101,18 @@ def parse_continue(index):
 def parse_if_statement(index):
     """Parse an if statement."""
 
-    index = match_token(index, token_kinds.if_kw, ParserError.GOT)
-    index = match_token(index, token_kinds.l_paren, ParserError.AFTER)
+    index = match_token(index, tks.if_kw, ParserError.GOT)
+    index = match_token(index, tks.l_paren, ParserError.AFTER)
     conditional, index = parse_expression(index)
-    index = match_token(index, token_kinds.r_paren, ParserError.AFTER)
+    index = match_token(index, tks.r_paren, ParserError.AFTER)
     statement, index = parse_statement(index)
 
     # If there is an else that follows, parse that too.
-    is_else = token_is(index, token_kinds.else_kw)
+    is_else = token_is(index, tks.else_kw)
     if not is_else:
         else_statement = None
     else:
-        index = match_token(index, token_kinds.else_kw, ParserError.GOT)
+        index = match_token(index, tks.else_kw, ParserError.GOT)
         else_statement, index = parse_statement(index)
 
     return nodes.IfStatement(conditional, statement, else_statement), index
@@ -116,10 +121,10 @@ def parse_if_statement(index):
 @add_range
 def parse_while_statement(index):
     """Parse a while statement."""
-    index = match_token(index, token_kinds.while_kw, ParserError.GOT)
-    index = match_token(index, token_kinds.l_paren, ParserError.AFTER)
+    index = match_token(index, tks.while_kw, ParserError.GOT)
+    index = match_token(index, tks.l_paren, ParserError.AFTER)
     conditional, index = parse_expression(index)
-    index = match_token(index, token_kinds.r_paren, ParserError.AFTER)
+    index = match_token(index, tks.r_paren, ParserError.AFTER)
     statement, index = parse_statement(index)
 
     return nodes.WhileStatement(conditional, statement), index
@@ -128,8 +133,8 @@ def parse_while_statement(index):
 @add_range
 def parse_for_statement(index):
     """Parse a for statement."""
-    index = match_token(index, token_kinds.for_kw, ParserError.GOT)
-    index = match_token(index, token_kinds.l_paren, ParserError.AFTER)
+    index = match_token(index, tks.for_kw, ParserError.GOT)
+    index = match_token(index, tks.l_paren, ParserError.AFTER)
 
     first, second, third, index = _get_for_clauses(index)
     stat, index = parse_statement(index)
@@ -151,19 +156,19 @@ def _get_for_clauses(index):
 
     first, index = _get_first_for_clause(index)
 
-    if token_is(index, token_kinds.semicolon):
+    if token_is(index, tks.semicolon):
         second = None
         index += 1
     else:
         second, index = parse_expression(index)
-        index = match_token(index, token_kinds.semicolon, ParserError.AFTER)
+        index = match_token(index, tks.semicolon, ParserError.AFTER)
 
-    if token_is(index, token_kinds.r_paren):
+    if token_is(index, tks.r_paren):
         third = None
         index += 1
     else:
         third, index = parse_expression(index)
-        index = match_token(index, token_kinds.r_paren, ParserError.AFTER)
+        index = match_token(index, tks.r_paren, ParserError.AFTER)
 
     return first, second, third, index
 
@@ -179,14 +184,14 @@ def _get_first_for_clause(index):
     If malformed, raises exception.
 
     """
-    if token_is(index, token_kinds.semicolon):
+    if token_is(index, tks.semicolon):
         return None, index + 1
 
     with log_error():
         return parse_declaration(index)
 
     clause, index = parse_expression(index)
-    index = match_token(index, token_kinds.semicolon, ParserError.AFTER)
+    index = match_token(index, tks.semicolon, ParserError.AFTER)
     return clause, index
 
 
@@ -197,9 +202,18 @@ def parse_expr_statement(index):
     Ex: a = 3 + 4
 
     """
-    if token_is(index, token_kinds.semicolon):
+    if token_is(index, tks.semicolon):
         return nodes.EmptyStatement(), index + 1
 
     node, index = parse_expression(index)
-    index = match_token(index, token_kinds.semicolon, ParserError.AFTER)
+    index = match_token(index, tks.semicolon, ParserError.AFTER)
     return nodes.ExprStatement(node), index
+
+
+statement_parsers = tks.KindTable({tks.l_brack: parse_compound_statement,
+                                   tks.return_kw: parse_return,
+                                   tks.break_kw: parse_break,
+                                   tks.continue_kw: parse_continue,
+                                   tks.if_kw: parse_if_statement,
+                                   tks.while_kw: parse_while_statement,
+                                   tks.for_kw: parse_for_statement})
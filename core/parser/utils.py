@@ -1,47 +1,201 @@
 
 from contextlib import contextmanager
-import copy
+from contextvars import ContextVar
+from itertools import count
 
+from core import tokens as tks
 from core.errors import CompilerError, Range
 
-tokens = None
+# The Parser running in this thread or task. The parse functions read its
+# state as attributes of this module: `tokens`, `symbols`, `best_error`,
+# `packrat`, `memo` and `lazy_bodies` are looked up on it by `__getattr__`.
+current_parser = ContextVar("current_parser", default=None)
+parser_state = {"tokens", "symbols", "best_error", "packrat", "memo",
+                "lazy_bodies"}
+
+
+def __getattr__(name):
+    parser = current_parser.get()
+    if name in parser_state and parser is not None:
+        return getattr(parser, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 class SimpleSymbolTable:
-    def __init__(self):
+    """Tracks which names are typedefs in each scope.
+
+    While a checkpoint is held, every change is recorded in an undo log as
+    a function and the arguments that reverse it, so `rollback` restores
+    the table in time proportional to the changes since the checkpoint.
+
+    `state` identifies the table's contents: it changes with every
+    symbol added, and goes back to its old value when a scope ends or a
+    change is rolled back.
+
+    `file_typedefs` logs each change to whether a name is a typedef in file
+    scope, so the typedefs of any earlier point can be recovered with
+    `file_typedefs_at`. A new table can start with `typedefs` already
+    declared in file scope, and with the `scopes` from `inner_scopes`
+    open inside it.
+
+    """
+
+    def __init__(self, typedefs=(), scopes=()):
         self.symbols = []
+        self.scope_states = []
+        self.file_typedefs = []
+        self.undo_log = []
+        self.checkpoints = 0
+        self.states = count()
+        self.state = next(self.states)
         self.new_scope()
+        self.symbols[0].update(typedefs)
+        self.file_typedefs.extend(self.symbols[0].items())
+        for scope in scopes:
+            self.new_scope()
+            self.symbols[-1].update(scope)
 
     def new_scope(self):
         self.symbols.append({})
+        self.scope_states.append(self.state)
+        self.state = next(self.states)
+        if self.checkpoints:
+            self.undo_log.append((self._undo_new_scope,))
 
     def end_scope(self):
+        table = self.symbols.pop()
+        self.state = self.scope_states.pop()
+        if self.checkpoints:
+            self.undo_log.append((self._undo_end_scope, table, self.state))
+
+    def _undo_new_scope(self):
         self.symbols.pop()
+        self.scope_states.pop()
+
+    def _undo_end_scope(self, table, outer_state):
+        self.symbols.append(table)
+        self.scope_states.append(outer_state)
+
+    def add_symbol(self, name, is_typedef):
+        table = self.symbols[-1]
+        if self.checkpoints:
+            if name in table:
+                self.undo_log.append((table.__setitem__, name, table[name]))
+            else:
+                self.undo_log.append((table.pop, name))
+
+        if len(self.symbols) == 1 and (is_typedef or table.get(name)):
+            self.file_typedefs.append((name, is_typedef))
+            if self.checkpoints:
+                self.undo_log.append((self.file_typedefs.pop,))
+
+        table[name] = is_typedef
+        self.state = next(self.states)
+
+    def file_typedefs_at(self, mark):
+        """Return the file scope typedefs from when the log had `mark` entries.
+
+        They are returned as a dict of each typedef name to True, ready to
+        start a new table with.
+
+        """
+        names = {}
+        for name, is_typedef in self.file_typedefs[:mark]:
+            if is_typedef:
+                names[name] = True
+            else:
+                names.pop(name, None)
+        return names
+
+    def inner_scopes(self):
+        """Return copies of the scopes open inside file scope, outermost first.
 
-    def add_symbol(self, identifier, is_typedef):
-        self.symbols[-1][identifier.content] = is_typedef
+        Inside a function these are few and small, unlike file scope, so
+        they are copied rather than logged.
 
-    def is_typedef(self, identifier):
-        name = identifier.content
-        for table in self.symbols[::-1]:
+        """
+        return [dict(table) for table in self.symbols[1:]]
+
+    def checkpoint(self):
+        """Start recording changes, and return a mark to roll back to."""
+        self.checkpoints += 1
+        return len(self.undo_log), self.state
+
+    def rollback(self, mark):
+        """Undo every change made since `checkpoint` returned `mark`."""
+        length, self.state = mark
+        while len(self.undo_log) > length:
+            undo, *args = self.undo_log.pop()
+            undo(*args)
+
+    def release(self):
+        """End a checkpoint; the log is dropped once none are held."""
+        self.checkpoints -= 1
+        if not self.checkpoints:
+            self.undo_log.clear()
+
+    def is_typedef(self, name):
+        """Return whether `name` is a typedef in the innermost scope naming it.
+
+        Identifier names come interned from the lexer, so each scope lookup
+        is normally settled by an identity check on the key.
+
+        """
+        for table in reversed(self.symbols):
             if name in table:
                 return table[name]
         return False
 
 
-symbols = SimpleSymbolTable()
-
 class ParserError(CompilerError):
+    """An error parsing the token at `amount_parsed`.
+
+    Most ParserErrors are raised by a speculative parse and dropped by
+    log_error, so one only keeps the message, the token index and the form
+    of the message. `descrip` and `range` are worked out the first time
+    they are read, which is normally only for the error that is reported.
+    With no message, the error reads "expected" and the `kind` wanted.
+
+    """
+
     AT = 1
     GOT = 2
     AFTER = 3
 
-    def __init__(self, message, index, tokens, message_type):
-        
+    warning = False
+
+    def __init__(self, message, index, tokens, message_type, kind=None):
+        self.message = message
         self.amount_parsed = index
+        self.tokens = tokens
+        self.message_type = message_type
+        self.kind = kind
+        self._formatted = None
+
+    @property
+    def descrip(self):
+        return self.format()[0]
+
+    @property
+    def range(self):
+        return self.format()[1]
+
+    def format(self):
+        """Return the description and range of this error."""
+        if self._formatted is None:
+            self._formatted = self._format()
+        return self._formatted
+
+    def _format(self):
+        tokens = self.tokens
+        index = self.amount_parsed
+        message_type = self.message_type
+        message = self.message
+        if not message:
+            message = f"expected '{self.kind.text_repr}'"
 
         if len(tokens) == 0:
-            super().__init__(f"{message} at beginning of source")
-            return
+            return f"{message} at beginning of source", None
 
         # If the index is too big, we're always using the AFTER form
         if index >= len(tokens):
@@ -54,88 +208,131 @@ class ParserError(CompilerError):
                 message_type = self.GOT
 
         if message_type == self.AT:
-            super().__init__(f"{message} at '{tokens[index]}'",
-                             tokens[index].r)
+            return f"{message} at '{tokens[index]}'", tokens[index].r
         elif message_type == self.GOT:
-            super().__init__(f"{message}, got '{tokens[index]}'",
-                             tokens[index].r)
+            return f"{message}, got '{tokens[index]}'", tokens[index].r
         elif message_type == self.AFTER:
             if tokens[index - 1].r:
                 new_range = Range(tokens[index - 1].r.end + 1)
             else:
                 new_range = None
 
-            super().__init__(
-                f"{message} after '{tokens[index - 1]}'", new_range)
+            return f"{message} after '{tokens[index - 1]}'", new_range
 
 
 def raise_error(err, index, error_type):
-    global tokens
-    raise ParserError(err, index, tokens, error_type)
+    raise ParserError(err, index, current_parser.get().tokens, error_type)
 
-best_error = None
+# In packrat mode, a Parser's memo holds the results of the parse functions
+# wrapped by `add_range`, keyed by function, token index, arguments and
+# symbol table state. Once `memo_limit` results are held, it is emptied.
+memo_limit = 1 << 20
 
 @contextmanager
 def log_error():
 
-    global best_error, symbols
+    parser = current_parser.get()
+    symbols = parser.symbols
 
-    # back up the global symbols table, so if parsing fails we can reset it
-    symbols_bak = copy.deepcopy(symbols)
+    # mark the symbol table, so if parsing fails we can roll it back
+    mark = symbols.checkpoint()
     try:
         yield
     except ParserError as e:
-        if not best_error or e.amount_parsed >= best_error.amount_parsed:
-            best_error = e
-        symbols = symbols_bak
+        parser.note_error(e)
+        symbols.rollback(mark)
+    finally:
+        symbols.release()
 
 
 def token_is(index, kind):
     """Return true if the next token is of the given kind."""
-    global tokens
-    return len(tokens) > index and tokens[index].kind == kind
+    tokens = current_parser.get().tokens
+    return len(tokens) > index and tokens.kinds[index] == kind.id
 
 
 def token_in(index, kinds):
-    """Return true if the next token is in the given list/set of kinds."""
-    global tokens
-    return len(tokens) > index and tokens[index].kind in kinds
+    """Return true if the next token is in the given KindTable."""
+    tokens = current_parser.get().tokens
+    return (len(tokens) > index
+            and kinds.lookup(tokens.kinds[index]) is not None)
 
 
 def match_token(index, kind, message_type, message=None):
 
-    global tokens
-    if not message:
-        message = f"expected '{kind.text_repr}'"
-
     if token_is(index, kind):
         return index + 1
     else:
-        raise ParserError(message, index, tokens, message_type)
-
-
-def token_range(start, end):
-    global tokens
-
-    start_index = min(start, len(tokens) - 1, end - 1)
-    end_index = min(end - 1, len(tokens) - 1)
-    return tokens[start_index].r + tokens[end_index].r
+        raise ParserError(message, index, current_parser.get().tokens,
+                          message_type, kind)
+
+
+def matching_brace(index):
+    """Return the index of the "}" closing the "{" at `index`, or None."""
+    kinds = current_parser.get().tokens.kinds
+    l_brack, r_brack = tks.l_brack.id, tks.r_brack.id
+
+    depth = 0
+    next_open = index
+    next_close = find_kind(kinds, r_brack, index)
+    while next_close is not None:
+        if next_open is not None and next_open < next_close:
+            depth += 1
+            next_open = find_kind(kinds, l_brack, next_open + 1)
+        else:
+            depth -= 1
+            if depth == 0:
+                return next_close
+            next_close = find_kind(kinds, r_brack, next_close + 1)
+    return None
+
+
+def find_kind(kinds, kind_id, start):
+    try:
+        return kinds.index(kind_id, start)
+    except ValueError:
+        return None
 
 
 def add_range(parse_func):
     """Return a decorated function that tags the produced node with a range.
 
     Accepts a parse_* function, and returns a version of the function where
-    the returned node has its range attribute set
+    the returned node has its span of tokens set, from which its range
+    attribute is made when read.
 
     """
-    global tokens
 
     def parse_with_range(index, *args):
-        start_index = index
-        node, end_index = parse_func(index, *args)
-        node.r = token_range(start_index, end_index)
+        parser = current_parser.get()
+        packrat = parser.packrat
+        if packrat:
+            key = (parse_with_range, index, args, parser.symbols.state)
+            result = parser.memo.get(key)
+            if isinstance(result, ParserError):
+                raise result.with_traceback(None)
+            elif result is not None:
+                return result
 
+        start_index = index
+        try:
+            node, end_index = parse_func(index, *args)
+        except ParserError as e:
+            if packrat:
+                remember(parser.memo, key, e)
+            raise
+        node.set_span(parser.tokens, start_index, end_index)
+
+        # A parse that changed the symbol table cannot be replayed from
+        # the memo, so it is only remembered if the state is unchanged.
+        if packrat and parser.symbols.state == key[3]:
+            remember(parser.memo, key, (node, end_index))
         return node, end_index
 
     return parse_with_range
+
+
+def remember(memo, key, result):
+    if len(memo) >= memo_limit:
+        memo.clear()
+    memo[key] = result
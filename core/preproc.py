@@ -0,0 +1,352 @@
+import os
+
+from core import lexer
+from core import tokens as tks
+from core.errors import CompilerError, error_collector
+from core.macros import Macro, MacroExpander, append_tokens, source_token
+
+
+class Header:
+    """A lexed header file, kept for every later include of it.
+
+    `guard` is the macro of the include guard wrapping the whole file, if
+    it has one, and `errors` are its lexer errors as given by
+    `lexer.error_offsets`.
+
+    """
+
+    def __init__(self, tokens, stamp, errors):
+        self.tokens = tokens
+        self.stamp = stamp
+        self.errors = errors
+        self.guard = find_guard(tokens)
+
+
+class Preprocessor:
+    """Runs #include, #define and conditional directives over lexed files.
+
+    A Preprocessor can be kept for a whole batch of files. Each header is
+    lexed once and its tokens reused for every include of it, as long as
+    the file is unchanged. A header with "#pragma once", or wrapped in an
+    include guard whose macro is defined, is skipped when included again
+    without looking at its tokens.
+
+    `macros` is the MacroExpander of the file being processed, or of the
+    last one.
+
+    """
+
+    max_depth = 200
+
+    def __init__(self, include_dirs=()):
+        self.include_dirs = list(include_dirs)
+        self.headers = {}
+        self.once = set()
+
+        self.macros = MacroExpander()
+        self.included = set()
+
+    def process(self, tokens, this_file):
+        """Preprocess the tokens of a file and return the result.
+
+        `this_file` is the file's path, which quoted includes are found
+        relative to. Macros start out undefined for every file.
+
+        """
+        self.macros = MacroExpander()
+        self.included = set()
+
+        out = tks.TokenBuffer(tokens.source)
+        self.process_tokens(tokens, this_file, out, 0)
+        return out
+
+    def process_tokens(self, tokens, this_file, out, depth):
+        conditions = []
+        active = True
+        copied = 0
+
+        for start, stop in directives(tokens):
+            if active:
+                self.copy(tokens, copied, start, out)
+            copied = stop
+
+            name = token_text(tokens, start + 1) if start + 1 < stop else ""
+            if name in {"if", "ifdef", "ifndef"}:
+                conditions.append((start, active, False))
+                active = active and self.condition(tokens, start, stop, name)
+            elif name in {"elif", "else"}:
+                if not conditions:
+                    self.error(f"#{name} without #if", tokens, start)
+                    continue
+                if_start, outer, taken = conditions[-1]
+                taken = taken or active
+                conditions[-1] = (if_start, outer, taken)
+                active = outer and not taken and (
+                    name == "else"
+                    or self.condition(tokens, start, stop, name))
+            elif name == "endif":
+                if not conditions:
+                    self.error("#endif without #if", tokens, start)
+                    continue
+                _, active, _ = conditions.pop()
+            elif active:
+                self.directive(tokens, start, stop, name, this_file, out,
+                               depth)
+
+        if active:
+            self.copy(tokens, copied, len(tokens), out)
+        for start, _, _ in conditions:
+            self.error("unterminated conditional directive", tokens, start)
+
+    def condition(self, tokens, start, stop, name):
+        """Return whether the branch a conditional directive opens is taken.
+
+        Only #ifdef and #ifndef are supported; an #if or #elif is reported
+        and its branch is not taken.
+
+        """
+        if name not in {"ifdef", "ifndef"}:
+            self.error(f"#{name} is not supported", tokens, start)
+            return False
+
+        macro = self.macro_name(tokens, start, stop)
+        return (macro in self.macros) == (name == "ifdef")
+
+    def directive(self, tokens, start, stop, name, this_file, out, depth):
+        if name == "include":
+            self.include(tokens, start, stop, this_file, out, depth)
+
+        elif name == "define":
+            self.define(tokens, start, stop)
+
+        elif name == "undef":
+            self.macros.undefine(self.macro_name(tokens, start, stop))
+
+        elif name == "pragma":
+            if (start + 2 < stop
+                  and token_text(tokens, start + 2) == "once"):
+                self.once.add(os.path.realpath(this_file))
+
+        elif name:
+            self.error(f"unrecognized preprocessor directive '#{name}'",
+                       tokens, start + 1)
+
+    def define(self, tokens, start, stop):
+        name = self.macro_name(tokens, start, stop)
+        if name is None:
+            return
+
+        body = start + 3
+        params = None
+        if (body < stop and tokens.kinds[body] == tks.l_paren.id
+              and tokens.starts[body] == tokens.ends[start + 2] + 1):
+            params, body = self.macro_params(tokens, body, stop)
+            if params is None:
+                return
+
+        self.macros.define(Macro(name, params, [source_token(tokens, i)
+                                                for i in range(body, stop)]))
+
+    def macro_params(self, tokens, i, stop):
+        """Read the parameter list of a function-like #define.
+
+        `i` is the index of its "(". Returns the parameter names and the
+        index after the ")", or None if the list is malformed.
+
+        """
+        kinds = tokens.kinds
+        params = []
+        i += 1
+        while i < stop:
+            if kinds[i] == tks.r_paren.id and not params:
+                return params, i + 1
+            if kinds[i] != tks.identifier.id:
+                break
+            params.append(tokens.content(i))
+            i += 1
+            if i < stop and kinds[i] == tks.r_paren.id:
+                return params, i + 1
+            if i >= stop or kinds[i] != tks.comma.id:
+                break
+            i += 1
+
+        self.error("invalid macro parameter list", tokens, min(i, stop - 1))
+        return None, i
+
+    def macro_name(self, tokens, start, stop):
+        if (start + 2 < stop
+              and tokens.kinds[start + 2] == tks.identifier.id):
+            return tokens.content(start + 2)
+
+        self.error("macro names must be identifiers", tokens,
+                   min(start + 2, stop - 1))
+        return None
+
+    def include(self, tokens, start, stop, this_file, out, depth):
+        if (start + 2 >= stop
+              or tokens.kinds[start + 2] != tks.include_file.id):
+            err = "#include expects \"FILENAME\" or <FILENAME>"
+            self.error(err, tokens, start + 1)
+            return
+        if depth >= self.max_depth:
+            self.error("#include nested too deeply", tokens, start + 2)
+            return
+
+        name = tokens.content(start + 2)
+        path = self.find_header(name, this_file)
+        if path is None:
+            self.error(f"unable to find included file {name}", tokens,
+                       start + 2)
+            return
+
+        cached = self.headers.get(path)
+        if cached is not None:
+            if path in self.included and path in self.once:
+                return
+            if cached.guard is not None and cached.guard in self.macros:
+                return
+
+        try:
+            header = self.read_header(path, cached)
+        except OSError:
+            self.error("unable to read included file", tokens, start + 2)
+            return
+
+        if path not in self.included:
+            self.included.add(path)
+            if header is cached:
+                lexer.report_errors(header.errors, header.tokens.source)
+        self.process_tokens(header.tokens, path, out, depth + 1)
+
+    def find_header(self, name, this_file):
+        """Return the real path of the header `name` names, or None.
+
+        A quoted name is looked for next to the including file and then in
+        the include directories; a name in angle brackets only in the latter.
+
+        """
+        dirs = self.include_dirs
+        if name.startswith('"'):
+            dirs = [os.path.dirname(this_file)] + dirs
+
+        for directory in dirs:
+            path = os.path.join(directory, name[1:-1])
+            if os.path.isfile(path):
+                return os.path.realpath(path)
+        return None
+
+    def read_header(self, path, header):
+        """Return the lexed header at `path`, lexing it if it has changed."""
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if header is not None and header.stamp == stamp:
+            return header
+
+        with open(path, "rb") as file:
+            tokens = lexer.tokenize(file.read(), path)
+
+        errors = lexer.error_offsets(tokens.source)
+        self.once.discard(path)
+        header = self.headers[path] = Header(tokens, stamp, errors)
+        return header
+
+    def copy(self, tokens, start, stop, out):
+        """Copy tokens [start, stop) to `out`, expanding macros in them."""
+        kinds, values, strings = tokens.kinds, tokens.values, tokens.strings
+        identifier = tks.identifier.id
+        macros = self.macros.macros
+        shift = out.source_base(tokens.source)
+        copied = i = start
+
+        while i < stop:
+            if kinds[i] == identifier and strings[values[i]] in macros:
+                out.extend(tokens, copied, shift, i)
+                expansion, i = self.macros.expand_at(tokens, i, stop)
+                append_tokens(out, expansion)
+                copied = i
+            else:
+                i += 1
+
+        out.extend(tokens, copied, shift, stop)
+
+    def error(self, descrip, tokens, index):
+        error_collector.add(CompilerError(descrip, tokens.range(index)))
+
+
+def directives(tokens):
+    """Yield the [start, stop) token range of each directive in `tokens`.
+
+    A directive is a logical line whose first token is "#".
+
+    """
+    kinds = tokens.kinds
+    pound = tks.pound.id
+    i = 0
+    while True:
+        try:
+            i = kinds.index(pound, i)
+        except ValueError:
+            return
+
+        if line_break_before(tokens, i):
+            stop = i + 1
+            while stop < len(tokens) and not line_break_before(tokens, stop):
+                stop += 1
+            yield i, stop
+            i = stop
+        else:
+            i += 1
+
+
+def line_break_before(tokens, i):
+    """Check if a logical line ends between tokens i - 1 and i."""
+    if i == 0:
+        return True
+
+    source = tokens.source
+    text = source.text
+    gap = source.line_break.finditer(text, tokens.ends[i - 1] + 1,
+                                     tokens.starts[i])
+    return any(not lexer.ends_with_backslash(
+        text[match.start() - 1:match.start()]) for match in gap)
+
+
+def find_guard(tokens):
+    """Return the macro of the include guard wrapping `tokens`, or None.
+
+    That is the macro tested by an #ifndef on the first line, when the
+    #endif that closes it is on the last line and it has no #else or #elif,
+    whose branch would still be included once the macro is defined.
+
+    """
+    found = directives(tokens)
+    first = next(found, None)
+    if (first is None or first[0] != 0 or first[1] < 3
+          or token_text(tokens, 1) != "ifndef"
+          or tokens.kinds[2] != tks.identifier.id):
+        return None
+
+    depth = 1
+    for start, stop in found:
+        name = token_text(tokens, start + 1) if start + 1 < stop else ""
+        if name in {"if", "ifdef", "ifndef"}:
+            depth += 1
+        elif name in {"elif", "else"} and depth == 1:
+            return None
+        elif name == "endif":
+            depth -= 1
+            if depth == 0:
+                return tokens.content(2) if stop == len(tokens) else None
+    return None
+
+
+def token_text(tokens, index):
+    return tokens.content(index) or tokens.kind(index).text_repr
+
+
+preprocessor = Preprocessor()
+
+
+def process(tokens, this_file):
+    """Preprocess the tokens of a file with the shared Preprocessor."""
+    return preprocessor.process(tokens, this_file)
@@ -0,0 +1,118 @@
+import contextlib
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+from core import lexer
+from core import tokens as tks
+from core.errors import Source
+
+
+def lexer_version():
+    """Hash the code that decides what tokens a source lexes to.
+
+    Cache keys include it, so entries written by an older lexer are never
+    read back; they are simply evicted once they are the least recently
+    used.
+
+    """
+    digest = hashlib.sha256()
+    for module in (lexer, tks):
+        with open(module.__file__, "rb") as file:
+            digest.update(file.read())
+    digest.update(f"{marshal.version} {sys.byteorder}".encode())
+    return digest.digest()
+
+
+class TokenCache:
+    """Lexed sources stored in a directory, keyed by a hash of their text.
+
+    Each entry holds a token buffer and its lexer errors. Builds running at
+    the same time may share a directory: entries are written to a temporary
+    file and renamed into place, so a reader sees a whole entry or none.
+    Reading an entry marks it as recently used, and when the directory grows
+    past `max_size` bytes the least recently used entries are removed.
+
+    """
+
+    version = None
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+        if TokenCache.version is None:
+            TokenCache.version = lexer_version()
+
+    def tokenize(self, code, filename, recover=False, max_errors=None):
+        """Lex `code` like `lexer.tokenize`, using the cache when possible."""
+        key = self.key(code, recover, max_errors)
+        entry = self.load(key)
+        if entry is not None:
+            state, errors = entry
+            source = Source(filename, lexer.source_text(code))
+            lexer.report_errors(errors, source)
+            return tks.load_buffer(source, state)
+
+        tokens = lexer.tokenize(code, filename, recover=recover,
+                                max_errors=max_errors)
+        self.store(key, (tokens.dump(), lexer.error_offsets(tokens.source)))
+        return tokens
+
+    def key(self, code, recover, max_errors):
+        digest = hashlib.sha256(self.version)
+        digest.update(f"{recover} {max_errors}\0".encode())
+        digest.update(code.encode() if isinstance(code, str) else code)
+        return digest.hexdigest()
+
+    def load(self, key):
+        """Return the entry stored under `key`, or None if there is none."""
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path)
+            return marshal.loads(data)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def store(self, key, entry):
+        """Write `entry` under `key`, then evict entries if over the limit.
+
+        A failed write is ignored, as the entry can always be lexed again.
+
+        """
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                marshal.dump(entry, file)
+            os.replace(temp, os.path.join(self.directory, key))
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temp)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under `max_size`."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+            total += stat.st_size
+
+        entries.sort()
+        for _, path, size in entries:
+            if total <= self.max_size:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            total -= size
@@ -1,16 +1,57 @@
 
+from array import array
+from bisect import bisect_left, bisect_right
+
+from core.errors import SourceRange
+
+all_kinds = []
+
 class TokenKind:
 
     def __init__(self, text_repr="", kinds=[]):
 
         self.text_repr = text_repr
+        self.id = len(all_kinds)
+        all_kinds.append(self)
         kinds.append(self)
-        kinds.sort(key=lambda kind: -len(kind.text_repr))
 
     def __str__(self):
         return self.text_repr
 
 
+class KindTable:
+    """A dispatch table from token kinds to values, indexed by kind id.
+
+    Built from a dict of kind to value, or from an iterable of kinds to make
+    a set-like table. Looking up a kind id is a single list index.
+
+    """
+
+    def __init__(self, items=()):
+        if not isinstance(items, dict):
+            items = dict.fromkeys(items, True)
+
+        self.values = [None] * len(all_kinds)
+        for kind, value in items.items():
+            self.values[kind.id] = value
+
+    def lookup(self, kind_id):
+        """Return the value for the given kind id, or None."""
+        try:
+            return self.values[kind_id]
+        except IndexError:
+            return None
+
+    def __getitem__(self, kind):
+        value = self.lookup(kind.id)
+        if value is None:
+            raise KeyError(kind)
+        return value
+
+    def __contains__(self, kind):
+        return self.lookup(kind.id) is not None
+
+
 class Token:
     def __init__(self, kind, content="", rep="", r=None):
         self.kind = kind
@@ -25,6 +66,315 @@ class Token:
     def __str__(self):
         return self.rep if self.rep else self.content
 
+
+class TokenBuffer:
+    """The tokens of one source, stored as parallel arrays.
+
+    Each token is a kind id, inclusive start and end offsets into `source`,
+    and indexes into `strings` for its content and its representation (-1 if
+    it has none). Identifier and number text is interned in `strings`, so
+    each distinct name is stored once. Indexing the buffer builds a Token on
+    demand; the parser helpers read the arrays directly instead.
+
+    Tokens from other sources, such as included files, are given offsets
+    past the end of `source`: each of `sources` starts at the offset at the
+    same index of `bases`.
+
+    `splice` moves the tokens after an edit lazily, as `OffsetArray` does:
+    the offsets of tokens from `_step_from` on are stored `_step` short
+    until `starts` or `ends` is read.
+
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.sources = []
+        self.bases = []
+        self._bases = {}
+        self.kinds = array("H")
+        self._starts = array("q")
+        self._ends = array("q")
+        self._step_from = 0
+        self._step = 0
+        self.values = array("i")
+        self.reps = array("i")
+        self.strings = []
+        self._string_ids = {}
+
+    @property
+    def starts(self):
+        self._apply_step()
+        return self._starts
+
+    @property
+    def ends(self):
+        self._apply_step()
+        return self._ends
+
+    def _apply_step(self):
+        if self._step:
+            for offsets in (self._starts, self._ends):
+                add_to_offsets(offsets, self._step_from, len(offsets),
+                               self._step)
+            self._step = 0
+
+    def dump(self):
+        """Return the buffer's tokens as a tuple of bytes and strings.
+
+        The tuple can be written with `marshal` and read back into a buffer
+        with `load_buffer`.
+
+        """
+        return (self.kinds.tobytes(), self.starts.tobytes(),
+                self.ends.tobytes(), self.values.tobytes(),
+                self.reps.tobytes(), self.strings)
+
+    def _add_string(self, content):
+        if content is None or content == "":
+            return -1
+
+        if not isinstance(content, (str, bytes)):
+            self.strings.append(content)
+            return len(self.strings) - 1
+
+        value = self._string_ids.get(content)
+        if value is None:
+            value = self._string_ids[content] = len(self.strings)
+            self.strings.append(content)
+        return value
+
+    def append(self, kind, start, end, content=None, rep=None):
+        if self._step:
+            self._apply_step()
+        self.kinds.append(kind.id)
+        self._starts.append(start)
+        self._ends.append(end)
+        self.values.append(self._add_string(content))
+        self.reps.append(self._add_string(rep))
+
+    def truncate(self, length):
+        """Drop every token from `length` on."""
+        del self.kinds[length:]
+        del self._starts[length:]
+        del self._ends[length:]
+        self._step_from = min(self._step_from, length)
+        del self.values[length:]
+        del self.reps[length:]
+
+    def _take_strings(self, other, values, reps):
+        """Return string ids of buffer `other` as ids into this buffer.
+
+        For a few tokens each string is looked up as it comes. For more
+        tokens than `other` has strings, each string is looked up once into
+        a table, whose last entry is where the -1 of no string lands.
+
+        """
+        if len(values) < len(other.strings):
+            def take(i):
+                return self._add_string(other.strings[i]) if i >= 0 else -1
+        else:
+            table = [self._add_string(string) for string in other.strings]
+            table.append(-1)
+            take = table.__getitem__
+        return array("i", map(take, values)), array("i", map(take, reps))
+
+    def splice(self, start, stop, other, shift=0):
+        """Replace tokens [start, stop) with the tokens of buffer `other`.
+
+        The offsets of the tokens after the replaced ones are moved by
+        `shift`, and `other`'s source becomes this buffer's source. The
+        move is recorded in the pending step, so only the new tokens and
+        those between this edit and the last one are written.
+
+        """
+        for offsets, new in ((self._starts, other.starts),
+                             (self._ends, other.ends)):
+            move_step(offsets, self._step_from, self._step, start, stop)
+            offsets[start:stop] = new
+        self._step_from = start + len(other)
+        self._step += shift
+
+        self.kinds[start:stop] = other.kinds
+        self.values[start:stop], self.reps[start:stop] = self._take_strings(
+            other, other.values, other.reps)
+        self.source = other.source
+
+    def extend(self, other, start=0, shift=0, stop=None):
+        """Append tokens [start, stop) of buffer `other`.
+
+        Their offsets are moved by `shift`, for when `other` was lexed from a
+        piece of this buffer's source that begins at offset `shift`, or from
+        a source whose `source_base` is `shift`.
+
+        """
+        self._apply_step()
+        values, reps = self._take_strings(
+            other, other.values[start:stop], other.reps[start:stop])
+        self.kinds += other.kinds[start:stop]
+        self.values += values
+        self.reps += reps
+        for offsets, new in ((self._starts, other.starts[start:stop]),
+                             (self._ends, other.ends[start:stop])):
+            add_to_offsets(new, 0, len(new), shift)
+            offsets += new
+
+    def source_base(self, source):
+        """Return the offset at which `source` starts in this buffer.
+
+        A source the buffer has not seen is placed after the last one.
+
+        """
+        if source is self.source:
+            return 0
+
+        base = self._bases.get(source)
+        if base is None:
+            last_base, last = ((self.bases[-1], self.sources[-1])
+                               if self.sources else (0, self.source))
+            base = self._bases[source] = last_base + len(last.text) + 1
+            self.bases.append(base)
+            self.sources.append(source)
+        return base
+
+    def kind(self, index):
+        return all_kinds[self.kinds[index]]
+
+    def content(self, index):
+        value = self.values[index]
+        return self.strings[value] if value >= 0 else ""
+
+    def rep(self, index):
+        rep = self.reps[index]
+        return self.strings[rep] if rep >= 0 else ""
+
+    def range(self, index):
+        start, end = self._starts[index], self._ends[index]
+        if self._step and index >= self._step_from:
+            start += self._step
+            end += self._step
+        if not self.bases or start < self.bases[0]:
+            return SourceRange(self.source, start, end)
+
+        i = bisect_right(self.bases, start) - 1
+        base = self.bases[i]
+        return SourceRange(self.sources[i], start - base, end - base)
+
+    def span_range(self, start, end):
+        """Return the Range of tokens [start, end).
+
+        The span is clamped to the buffer, so an empty span at the end of
+        the buffer gives the range of its last token.
+
+        """
+        start_index = min(start, len(self) - 1, end - 1)
+        end_index = min(end - 1, len(self) - 1)
+        return self.range(start_index) + self.range(end_index)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("token index out of range")
+
+        return Token(self.kind(index), self.content(index), self.rep(index),
+                     self.range(index))
+
+
+def add_to_offsets(offsets, start, stop, shift):
+    """Add `shift` to entries [start, stop) of array `offsets` in place."""
+    if shift and start < stop:
+        offsets[start:stop] = array(
+            offsets.typecode, map(shift.__add__, offsets[start:stop]))
+
+
+def move_step(offsets, step_from, step, start, stop):
+    """Make a pending step of array `offsets` apply from `stop` on.
+
+    The step currently applies from `step_from` on. Only the entries
+    between `step_from` and the edit [start, stop) are rewritten; those in
+    the edit are left for the caller to replace.
+
+    """
+    if step_from < start:
+        add_to_offsets(offsets, step_from, start, step)
+    elif step_from > stop:
+        add_to_offsets(offsets, stop, step_from, -step)
+
+
+class OffsetArray:
+    """An array of offsets that are moved lazily when entries are replaced.
+
+    An edit moves every offset after it by the same amount. Rather than
+    rewrite them all, the move is kept as a pending step: entry i is stored
+    in `values` `step` short if i is at least `step_from`. A later edit only
+    rewrites the entries between it and the last one, so a run of edits
+    close together costs as much as the entries they replace.
+
+    """
+
+    def __init__(self):
+        self.values = array("q")
+        self.step_from = 0
+        self.step = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.values)
+        value = self.values[index]
+        return value + self.step if index >= self.step_from else value
+
+    def append(self, value):
+        self.values.append(value - self.step)
+
+    def splice(self, start, stop, new, shift):
+        """Replace entries [start, stop) with `new`, adding `shift` to the rest."""
+        new = array("q", new)
+        move_step(self.values, self.step_from, self.step, start, stop)
+        self.values[start:stop] = new
+        self.step_from = start + len(new)
+        self.step += shift
+
+    def bisect_left(self, value, lo=0):
+        """Return where `value` goes in the array, before equal entries."""
+        step_from = max(self.step_from, lo)
+        if (step_from < len(self.values)
+              and self.values[step_from] + self.step < value):
+            return bisect_left(self.values, value - self.step, step_from)
+        return bisect_left(self.values, value, lo, step_from)
+
+    def bisect_right(self, value, lo=0):
+        """Return where `value` goes in the array, after equal entries."""
+        step_from = max(self.step_from, lo)
+        if (step_from < len(self.values)
+              and self.values[step_from] + self.step <= value):
+            return bisect_right(self.values, value - self.step, step_from)
+        return bisect_right(self.values, value, lo, step_from)
+
+
+def load_buffer(source, state):
+    """Rebuild a TokenBuffer over `source` from `TokenBuffer.dump` output."""
+    kinds, starts, ends, values, reps, strings = state
+
+    tokens = TokenBuffer(source)
+    tokens.kinds.frombytes(kinds)
+    tokens.starts.frombytes(starts)
+    tokens.ends.frombytes(ends)
+    tokens.values.frombytes(values)
+    tokens.reps.frombytes(reps)
+    tokens.strings = list(strings)
+    tokens._string_ids = {string: i for i, string in enumerate(strings)
+                          if isinstance(string, (str, bytes))}
+    return tokens
+
 keyword_kinds = []
 symbol_kinds = []
 
@@ -32,6 +382,14 @@ bool_kw = TokenKind("bool", keyword_kinds)
 char_kw = TokenKind("string", keyword_kinds)
 int_kw = TokenKind("int", keyword_kinds)
 
+return_kw = TokenKind("return", keyword_kinds)
+if_kw = TokenKind("if", keyword_kinds)
+else_kw = TokenKind("else", keyword_kinds)
+while_kw = TokenKind("while", keyword_kinds)
+for_kw = TokenKind("for", keyword_kinds)
+break_kw = TokenKind("break", keyword_kinds)
+continue_kw = TokenKind("continue", keyword_kinds)
+
 plus = TokenKind("+", symbol_kinds)
 minus = TokenKind("-", symbol_kinds)
 star = TokenKind("*", symbol_kinds)
@@ -53,7 +411,10 @@ r_sq_brack = TokenKind("]", symbol_kinds)
 comma = TokenKind(",", symbol_kinds)
 semicolon = TokenKind(";", symbol_kinds)
 dot = TokenKind(".", symbol_kinds)
+pound = TokenKind("#", symbol_kinds)
 
 identifier = TokenKind()
 number = TokenKind()
 string = TokenKind()
+include_file = TokenKind()
+error = TokenKind()
@@ -1,4 +1,6 @@
-class DeclNode:
+from core.tree.utils import Ranged
+
+class DeclNode(Ranged):
     pass
 
 class Root(DeclNode):
@@ -25,6 +27,12 @@ class Array(DeclNode):
         self.child = child
         super().__init__()
 
+class Function(DeclNode):
+    def __init__(self, args, child):
+        self.args = args
+        self.child = child
+        super().__init__()
+
 class Identifier(DeclNode):
     def __init__(self, identifier):
         self.identifier = identifier
@@ -3,9 +3,10 @@ from core import ctypes
 import core.tree.decl_nodes as decl_nodes
 
 from core.errors import CompilerError
-from core.tree.utils import DirectLValue, report_err, set_type, check_cast
+from core.tree.utils import (DirectLValue, Ranged, report_err, set_type,
+                             check_cast)
 
-class Node:
+class Node(Ranged):
     def __init__(self):
         self.r = None
 
@@ -40,6 +41,28 @@ class Compound(Node):
         if not no_scope:
             symbol_table.end_scope()
 
+class LazyCompound(Compound):
+    """A compound statement that is parsed when its items are first read.
+
+    `parse` is called with no arguments to parse it, and returns the
+    Compound, or None if the statement has a syntax error. In that case
+    the error has been reported and `items` is empty.
+
+    """
+
+    def __init__(self, parse):
+        Node.__init__(self)
+        self._parse = parse
+        self._items = None
+
+    @property
+    def items(self):
+        if self._parse is not None:
+            compound = self._parse()
+            self._items = compound.items if compound else []
+            self._parse = None
+        return self._items
+
 class EmptyStatement(Node):
     def __init__(self):
         super().__init__()
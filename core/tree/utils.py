@@ -2,6 +2,37 @@ from contextlib import contextmanager
 
 from core.errors import CompilerError, error_collector
 
+class Ranged:
+    """A tree node with `r`, the Range of source it was parsed from.
+
+    The parser gives a node the token indices it spans with `set_span`,
+    and the Range is only made from the token buffer when `r` is first
+    read. Most nodes are never reported on, so most never make one.
+
+    """
+
+    _r = None
+    _tokens = None
+
+    @property
+    def r(self):
+        if self._tokens is not None:
+            self._r = self._tokens.span_range(self._start, self._end)
+            self._tokens = None
+        return self._r
+
+    @r.setter
+    def r(self, r):
+        self._r = r
+        self._tokens = None
+
+    def set_span(self, tokens, start, end):
+        """Make `r` the range of tokens [start, end) of buffer `tokens`."""
+        self._tokens = tokens
+        self._start = start
+        self._end = end
+
+
 class LValue:
     """Represents an LValue."""
 
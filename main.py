@@ -1,5 +1,7 @@
+import mmap
+import os
 import sys
-from core import lexer, error_collector
+from core import lexer, preproc, error_collector
 from core.parser import parser
 
 def main() -> None:
@@ -10,10 +12,14 @@ def main() -> None:
         if len(sys.argv) <= 1:
             sys.exit('No file specified')
 
-        file = open(sys.argv[1])
-        code = file.read()
+        file = open(sys.argv[1], "rb")
+        if os.fstat(file.fileno()).st_size:
+            code = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            code = b""
         
         token_list = lexer.tokenize(code, file)
+        token_list = preproc.process(token_list, sys.argv[1])
         lexer_ok = 'OK' if error_collector.ok() else 'NOK'
 
         ast_root = parser.parse(token_list)
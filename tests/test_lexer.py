@@ -0,0 +1,176 @@
+"""Tests for the lexer."""
+
+import io
+import random
+import unittest
+
+import core.lexer as lexer
+from core.errors import error_collector
+
+
+def lex(tokenize, code, **kwargs):
+    """Return the tokens and errors of lexing `code` with `tokenize`."""
+    error_collector.clear()
+    tokens = tokenize(code, "test.c", **kwargs)
+    lexed = [(tokens.kinds[i], tokens.starts[i], tokens.ends[i],
+              tokens.content(i)) for i in range(len(tokens))]
+    errors = [(error.descrip, error.range.first)
+              for error in error_collector.issues]
+    error_collector.clear()
+    return lexed, errors
+
+
+def random_source(rand, lines):
+    """Return C-like text with CRLF breaks, continuations and comments."""
+    pieces = ["int", "x", "=", "1;", "/*", "*/", "//", "\\", "$", "\"s\"",
+              "'c'", "*", "/"]
+    breaks = ["\r\n", "\r\n", "\r\n", "\\\r\n", "\n", "\\\n"]
+    return "".join(
+        " ".join(rand.choice(pieces) for _ in range(rand.randrange(6)))
+        + rand.choice(breaks) for _ in range(lines))
+
+
+class ParallelTests(unittest.TestCase):
+    """Check that `tokenize_parallel` agrees with `tokenize`."""
+
+    def assertSameLex(self, code, shard_size):
+        """Check one source against the serial lexer."""
+        self.assertEqual(
+            lex(lexer.tokenize_parallel, code, workers=2,
+                shard_size=shard_size),
+            lex(lexer.tokenize, code), repr(code))
+
+    def test_crlf_continuations(self):
+        """Shards must not be cut after a continued CRLF line."""
+        code = "".join("x%d = 1; // note \\\r\n continued comment\r\n" % i
+                       for i in range(200))
+        self.assertSameLex(code, 256)
+        self.assertSameLex(code.encode(), 256)
+        self.assertSameLex("/* =\n\n*\\\r\n/x", 5)
+
+    def test_random_crlf_sources(self):
+        """Compare random CRLF sources cut into small shards."""
+        rand = random.Random(0)
+        for _ in range(20):
+            code = random_source(rand, 40)
+            self.assertSameLex(code, rand.randrange(1, 64))
+
+
+class RelexTests(unittest.TestCase):
+    """Check that `relex` leaves the state a fresh lex would."""
+
+    def errors(self):
+        """Return the collected errors as text and offsets."""
+        return [(error.descrip, error.range.first)
+                for error in error_collector.issues]
+
+    def test_errors_replaced(self):
+        """Errors of re-lexed lines are replaced, others are moved."""
+        error_collector.clear()
+        tokens, table = lexer.tokenize_incremental(
+            "a = $;\nb = 2;\nc = `;\n", "test.c")
+        lexer.relex(tokens, table, 4, 1, "1")
+        self.assertEqual(self.errors(),
+                         [("unrecognized token at '`'", 18)])
+        lexer.relex(tokens, table, 4, 1, "@@")
+        self.assertEqual(self.errors(),
+                         [("unrecognized token at '@@'", 4),
+                          ("unrecognized token at '`'", 19)])
+        error_collector.clear()
+
+    def test_tail_not_rewritten(self):
+        """The offsets of tokens after the re-lexed lines are not written."""
+        code = "int x = 1;\n" * 200
+        tokens, table = lexer.tokenize_incremental(code, "test.c")
+        for offset, inserted in ((4, "long_name"), (30, ""), (70, "z")):
+            tail = len(tokens) - 400
+            starts, ends = tokens._starts[tail:], tokens._ends[tail:]
+            lines = table.starts.values[-70:]
+
+            removed = 1 if inserted != "long_name" else 0
+            lexer.relex(tokens, table, offset, removed, inserted)
+            self.assertEqual(tokens._starts[-400:], starts)
+            self.assertEqual(tokens._ends[-400:], ends)
+            self.assertEqual(table.starts.values[-70:], lines)
+
+            code = code[:offset] + inserted + code[offset + removed:]
+            fresh = lexer.tokenize(code, "test.c")
+            self.assertEqual(
+                [(r.first, r.last) for r in map(tokens.range,
+                                                range(len(tokens)))],
+                [(r.first, r.last) for r in map(fresh.range,
+                                                range(len(fresh)))])
+            self.assertEqual(list(table.starts),
+                             lexer.tokenize_incremental(code, "test.c")[1]
+                             .starts.values.tolist())
+
+
+class RecoverTests(unittest.TestCase):
+    """Check the error tokens of a recovering lex."""
+
+    def test_unterminated_quote(self):
+        """An unterminated quote makes the rest of its line one error."""
+        code = 's = "costs $5 @ 10% off;  \nint y;\n'
+        for source in (code, code.encode()):
+            tokens, errors = lex(lexer.tokenize, source, recover=True,
+                                 max_errors=2)
+            self.assertEqual([content for _, _, _, content in tokens],
+                             ["s", "", '"costs $5 @ 10% off;', "", "y", ""])
+            self.assertEqual(errors, [("missing terminating quote", 4)])
+
+
+class ErrorLimitTests(unittest.TestCase):
+    """Check that `max_errors` stops lexing at the right error."""
+
+    def test_stops_mid_line(self):
+        """The limit applies to each error, not each line."""
+        tokens, errors = lex(lexer.tokenize, "$ $ $ $", recover=True,
+                             max_errors=2)
+        self.assertEqual(len(tokens), 2)
+        self.assertEqual(sorted(descrip for descrip, _ in errors),
+                         ["too many errors, lexing stopped",
+                          "unrecognized token at '$'",
+                          "unrecognized token at '$'"])
+
+    def test_clean_source(self):
+        """A source without errors is lexed to the end."""
+        tokens, errors = lex(lexer.tokenize, "int x;\nint y;\n",
+                             max_errors=1)
+        self.assertEqual((len(tokens), errors), (6, []))
+
+    def test_rejects_zero(self):
+        """A limit below 1 is an error."""
+        with self.assertRaises(ValueError):
+            lexer.tokenize("int x;", "test.c", max_errors=0)
+
+
+class StreamTests(unittest.TestCase):
+    """Check that `tokenize_stream` agrees with `tokenize`."""
+
+    def test_binary_file(self):
+        """A file opened in binary mode is decoded as UTF-8."""
+        code = "char *s = \"h\u00e9llo\"; // \u00fc\r\nint x;\\\r\n y;\n"
+        expected = [(t.kind, str(t))
+                    for t in lexer.tokenize(code, "test.c")]
+        for chunk_size in (1, 2, 5, 65536):
+            file = io.BytesIO(code.encode())
+            tokens = lexer.tokenize_stream(file, "test.c", chunk_size)
+            self.assertEqual([(t.kind, str(t)) for t in tokens], expected)
+
+    def test_chunk_boundaries(self):
+        """Lines may be cut anywhere, including inside a "\\r\\n"."""
+        rand = random.Random(1)
+        for _ in range(50):
+            code = random_source(rand, 20) + "x" * rand.randrange(300)
+            cuts = sorted(rand.randrange(len(code) + 1) for _ in range(30))
+            chunks = [code[start:end] for start, end
+                      in zip([0] + cuts, cuts + [len(code)])]
+            self.assertEqual(
+                [(t.kind, str(t), t.r.start.line, t.r.start.col)
+                 for t in lexer.tokenize_stream(chunks, "test.c")],
+                [(t.kind, str(t), t.r.start.line, t.r.start.col)
+                 for t in lexer.tokenize(code, "test.c")], repr(code))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+"""Tests for the macro expander."""
+
+import unittest
+
+import core.lexer as lexer
+from core import tokens as tks
+from core.macros import (CONTENT, KIND, PAINTED, WHERE, Macro, MacroExpander,
+                         source_token)
+
+
+def expansion_tokens(text):
+    """Return the tokens of `text` as expansion tokens."""
+    tokens = lexer.tokenize(text, "test.c")
+    return [source_token(tokens, i) for i in range(len(tokens))]
+
+
+def text(tokens):
+    """Return the text of expansion tokens, separated by spaces."""
+    return " ".join(token[CONTENT] or str(tks.all_kinds[token[KIND]])
+                    for token in tokens)
+
+
+class MacroExpanderTests(unittest.TestCase):
+    """Define macros and expand text with a MacroExpander."""
+
+    def setUp(self):
+        self.expander = MacroExpander()
+
+    def define(self, name, body, params=None):
+        self.expander.define(Macro(name, params, expansion_tokens(body)))
+
+    def expand(self, text):
+        """Expand every macro in `text`, returning the expanded tokens."""
+        return self.expander.rescan(expansion_tokens(text), frozenset())
+
+    def expand_text(self, code):
+        return text(self.expand(code))
+
+    def test_rescan(self):
+        """An expansion is rescanned for more macros to expand."""
+        self.define("A", "B + 1")
+        self.define("B", "C * 2")
+        self.define("C", "3")
+        self.assertEqual(self.expand_text("A"), "3 * 2 + 1")
+
+    def test_function_name_at_end(self):
+        """An expansion ending in a macro name takes the arguments after it."""
+        self.define("F", "x + x", ["x"])
+        self.define("G", "F")
+        self.assertEqual(self.expand_text("G(2)"), "2 + 2")
+
+    def test_arguments_expanded(self):
+        """Arguments are expanded before they are substituted."""
+        self.define("ONE", "1")
+        self.define("F", "(x)", ["x"])
+        self.assertEqual(self.expand_text("F(ONE)"), "( 1 )")
+
+    def test_blue_paint(self):
+        """A macro's name in its own expansion is painted, not expanded."""
+        self.define("X", "X + 1")
+        tokens = self.expand("X")
+        self.assertEqual(text(tokens), "X + 1")
+        self.assertTrue(tokens[0][PAINTED])
+
+        # A painted name stays unexpanded when rescanned again.
+        self.define("P", "Q")
+        self.define("Q", "P")
+        tokens = self.expand("P")
+        self.assertEqual([token[CONTENT] for token in tokens], ["P"])
+        self.assertTrue(tokens[0][PAINTED])
+        self.assertEqual(self.expander.rescan(tokens, frozenset()), tokens)
+
+    def test_argument_cache(self):
+        """Calls with the same argument text share one cached expansion."""
+        self.define("SQ", "x * x", ["x"])
+        source = expansion_tokens("SQ(a) SQ(a) SQ(b)")
+        tokens = self.expander.rescan(source, frozenset())
+        self.assertEqual(text(tokens), "a * a a * a b * b")
+        self.assertEqual((self.expander.misses, self.expander.hits), (2, 1))
+
+        # A cached expansion keeps the positions of its own arguments.
+        self.assertEqual(tokens[0][WHERE], source[2][WHERE])
+        self.assertEqual(tokens[3][WHERE], source[6][WHERE])
+
+    def test_counters(self):
+        """Hits, misses and the deepest nesting of expansions are counted."""
+        self.define("A", "B")
+        self.define("B", "C")
+        self.define("C", "1")
+        self.assertEqual(self.expand_text("A"), "1")
+        self.assertEqual((self.expander.misses, self.expander.hits), (3, 0))
+        self.assertEqual(self.expander.max_depth, 3)
+        self.assertEqual(self.expander.depth, 0)
+
+        # B is cached apart from its expansion inside A, where A is painted.
+        self.assertEqual(self.expand_text("A B"), "1 1")
+        self.assertEqual((self.expander.misses, self.expander.hits), (5, 1))
+        self.assertEqual(self.expander.max_depth, 3)
+
+    def test_redefine_drops_dependents(self):
+        """Redefining a macro drops only the expansions that looked it up."""
+        self.define("A", "B")
+        self.define("B", "1")
+        self.define("U", "2")
+        self.assertEqual(self.expand_text("A U"), "1 2")
+        self.assertEqual(len(self.expander.cache), 3)
+
+        self.define("B", "5")
+        self.assertEqual(len(self.expander.cache), 1)
+        self.assertEqual(self.expand_text("A U"), "5 2")
+        self.assertEqual((self.expander.misses, self.expander.hits), (5, 1))
+
+        # The same definition again changes nothing.
+        self.define("B", "5")
+        self.assertEqual(len(self.expander.cache), 3)
+
+    def test_define_name_looked_up(self):
+        """Defining a name an expansion looked up as a non-macro drops it."""
+        self.define("E", "Z + 1")
+        self.assertEqual(self.expand_text("E"), "Z + 1")
+        self.define("Y", "0")
+        self.assertEqual(len(self.expander.cache), 1)
+
+        self.define("Z", "7")
+        self.assertEqual(len(self.expander.cache), 0)
+        self.assertEqual(self.expand_text("E"), "7 + 1")
+
+    def test_undefine_drops_dependents(self):
+        """Undefining a macro drops the expansions that looked it up."""
+        self.define("A", "B")
+        self.define("B", "1")
+        self.assertEqual(self.expand_text("A"), "1")
+        self.expander.undefine("B")
+        self.assertEqual(self.expander.cache, {})
+        self.assertEqual(self.expander.dependents, {})
+        self.assertEqual(self.expand_text("A"), "B")
+
+
+if __name__ == "__main__":
+    unittest.main()
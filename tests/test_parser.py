@@ -0,0 +1,139 @@
+"""Tests for the parser."""
+
+import unittest
+
+import core.lexer as lexer
+import core.parser.utils as p
+import core.tree.nodes as nodes
+from core.errors import ErrorCollector
+from core.parser.parser import Parser
+from core.parser.statement import parse_compound_statement
+
+
+class PeakLogTable(p.SimpleSymbolTable):
+    """A symbol table that remembers the longest its undo log has been."""
+
+    peak = 0
+
+    def end_scope(self):
+        super().end_scope()
+        self.peak = max(self.peak, len(self.undo_log))
+
+
+class UndoLogTests(unittest.TestCase):
+    """Check when the symbol table records changes."""
+
+    def test_not_recorded_outside_speculation(self):
+        """Scopes a parse does not backtrack over are not logged."""
+        tokens = lexer.tokenize("{" + "{ a = 1; }" * 500 + "}", "test.c")
+        parser = Parser(tokens, errors=ErrorCollector())
+        parser.symbols = PeakLogTable()
+        node = parser.run(parse_compound_statement, 0)
+        self.assertEqual(len(node.items), 500)
+        self.assertEqual(parser.symbols.peak, 0)
+
+
+class MatchingBraceTests(unittest.TestCase):
+    """Find the brace closing a block without parsing it."""
+
+    def matching_brace(self, code, index):
+        parser = Parser(lexer.tokenize(code, "test.c"))
+        token = p.current_parser.set(parser)
+        self.addCleanup(p.current_parser.reset, token)
+        return p.matching_brace(index)
+
+    def test_nested(self):
+        """Inner blocks are skipped over."""
+        code = "{ { a; } { { b; } } c; } d;"
+        self.assertEqual(self.matching_brace(code, 0), 13)
+        self.assertEqual(self.matching_brace(code, 1), 4)
+        self.assertEqual(self.matching_brace(code, 5), 10)
+
+    def test_not_closed(self):
+        """A block that is not closed has no matching brace."""
+        self.assertIsNone(self.matching_brace("{ { a; }", 0))
+
+
+class LazyBodyTests(unittest.TestCase):
+    """Parse function bodies lazily, and check they match eager parses."""
+
+    def setUp(self):
+        self.errors = ErrorCollector()
+
+    def parse(self, code, lazy_bodies, typedefs=()):
+        tokens = lexer.tokenize(code, "test.c")
+        root = Parser(tokens, errors=self.errors, lazy_bodies=lazy_bodies,
+                      typedefs=typedefs).parse()
+        self.assertEqual(self.errors.issues, [])
+        return root
+
+    def kinds(self, compound):
+        return [type(item).__name__ for item in compound.items]
+
+    def test_parse_once(self):
+        """A LazyCompound parses when first read, and only then."""
+        calls = []
+
+        def parse():
+            calls.append(1)
+            return nodes.Compound([nodes.EmptyStatement()])
+
+        body = nodes.LazyCompound(parse)
+        self.assertEqual(calls, [])
+        self.assertEqual(len(body.items), 1)
+        self.assertEqual(len(body.items), 1)
+        self.assertEqual(calls, [1])
+
+    def test_parse_error(self):
+        """A body that does not parse has no items, and reports its error."""
+        root = self.parse("int f() { a = ; }", lazy_bodies=True)
+        body = root.nodes[0].body
+        self.assertIsInstance(body, nodes.LazyCompound)
+        self.assertEqual(body.items, [])
+        self.assertEqual(len(self.errors.issues), 1)
+        self.assertIn("expected expression", str(self.errors.issues[0]))
+
+    def test_same_as_eager(self):
+        """A lazy body parses the same as an eager one."""
+        code = "int f(int a, int *b) { a = 1; { *b = a; } } int g() { }"
+        eager = self.parse(code, lazy_bodies=False)
+        lazy = self.parse(code, lazy_bodies=True)
+        self.assertEqual(len(lazy.nodes), 2)
+        for eager_item, lazy_item in zip(eager.nodes, lazy.nodes):
+            self.assertIsInstance(lazy_item.body, nodes.LazyCompound)
+            self.assertEqual(self.kinds(lazy_item.body),
+                             self.kinds(eager_item.body))
+
+    def test_parameter_hides_typedef(self):
+        """A parameter hides a file scope typedef in a lazy body too."""
+        code = "int f(int T) { T * x; }"
+        eager = self.parse(code, lazy_bodies=False, typedefs={"T": True})
+        lazy = self.parse(code, lazy_bodies=True, typedefs={"T": True})
+        self.assertEqual(self.kinds(eager.nodes[0].body), ["ExprStatement"])
+        self.assertEqual(self.kinds(lazy.nodes[0].body), ["ExprStatement"])
+
+        # Without the parameter, T names a type.
+        lazy = self.parse("int f() { T * x; }", lazy_bodies=True,
+                          typedefs={"T": True})
+        self.assertEqual(self.kinds(lazy.nodes[0].body), ["Declaration"])
+
+    def test_defer_sees_scopes_when_deferred(self):
+        """A deferred parse sees the scopes as they were when deferred."""
+        tokens = lexer.tokenize("{ T * x; U * y; }", "test.c")
+        parser = Parser(tokens, errors=ErrorCollector(),
+                        typedefs={"T": True})
+        parser.symbols.new_scope()
+        parser.symbols.add_symbol("T", False)
+        parse_body = parser.defer(parse_compound_statement, 0)
+
+        # Later changes to the scopes are not seen.
+        parser.symbols.add_symbol("x", False)
+        parser.symbols.end_scope()
+        parser.symbols.add_symbol("U", True)
+
+        body = parse_body()
+        self.assertEqual(self.kinds(body), ["ExprStatement", "ExprStatement"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+"""Tests for the preprocessor."""
+
+import os
+import tempfile
+import unittest
+
+import core.lexer as lexer
+from core.errors import error_collector
+from core.preproc import Preprocessor, token_text
+
+
+class PreprocTests(unittest.TestCase):
+    """Run a Preprocessor over files in a temporary directory."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.preprocessor = Preprocessor()
+        error_collector.clear()
+        self.addCleanup(error_collector.clear)
+
+    def write(self, name, text):
+        """Write a file into the directory and return its path."""
+        path = os.path.join(self.dir.name, name)
+        with open(path, "w") as file:
+            file.write(text)
+        return path
+
+    def process(self, name, text):
+        """Preprocess `text` as file `name`, returning the token texts."""
+        path = self.write(name, text)
+        tokens = lexer.tokenize(text, path)
+        out = self.preprocessor.process(tokens, path)
+        self.assertEqual(error_collector.issues, [])
+        return " ".join(token_text(out, i) for i in range(len(out)))
+
+    def test_guard_skipped(self):
+        """A guarded header is only included once."""
+        self.write("a.h", "#ifndef A_H\n#define A_H\nint a;\n#endif\n")
+        self.assertEqual(
+            self.process("main.c", '#include "a.h"\n#include "a.h"\n'),
+            "int a ;")
+        header = next(iter(self.preprocessor.headers.values()))
+        self.assertEqual(header.guard, "A_H")
+
+    def test_guard_undefined(self):
+        """A guarded header is included again once its macro is undefined."""
+        self.write("a.h", "#ifndef A_H\n#define A_H\nint a;\n#endif\n")
+        self.assertEqual(
+            self.process("main.c", '#include "a.h"\n#undef A_H\n'
+                                   '#include "a.h"\n'),
+            "int a ; int a ;")
+
+    def test_guard_with_else(self):
+        """An #ifndef with an #else branch is not an include guard."""
+        self.write("a.h", "#ifndef G\n#define G\nint a;\n#else\nint b;\n"
+                          "#endif\n")
+        self.assertEqual(
+            self.process("main.c", '#include "a.h"\n#include "a.h"\n'),
+            "int a ; int b ;")
+        header = next(iter(self.preprocessor.headers.values()))
+        self.assertIsNone(header.guard)
+
+    def test_not_whole_file(self):
+        """An #ifndef that does not wrap the whole file is not a guard."""
+        self.write("a.h", "#ifndef G\n#define G\n#endif\nint a;\n")
+        self.assertEqual(
+            self.process("main.c", '#include "a.h"\n#include "a.h"\n'),
+            "int a ; int a ;")
+
+    def test_pragma_once(self):
+        """A header with "#pragma once" is only included once."""
+        self.write("a.h", "#pragma once\nint a;\n")
+        self.write("b.h", '#include "a.h"\nint b;\n')
+        self.assertEqual(
+            self.process("main.c", '#include "a.h"\n#include "b.h"\n'
+                                   '#include "a.h"\n'),
+            "int a ; int b ;")
+
+    def test_pragma_once_per_file(self):
+        """"#pragma once" does not carry over to the next file processed."""
+        self.write("a.h", "#pragma once\nint a;\n")
+        self.assertEqual(self.process("one.c", '#include "a.h"\n'), "int a ;")
+        self.assertEqual(self.process("two.c", '#include "a.h"\n'), "int a ;")
+
+    def test_header_cache(self):
+        """A header is lexed once for every file including it."""
+        path = self.write("a.h", "#ifndef A_H\n#define A_H\nint a;\n#endif\n")
+        lexed = []
+        tokenize = lexer.tokenize
+
+        def counting_tokenize(code, filename, *args, **kwargs):
+            lexed.append(filename)
+            return tokenize(code, filename, *args, **kwargs)
+
+        lexer.tokenize = counting_tokenize
+        self.addCleanup(setattr, lexer, "tokenize", tokenize)
+        self.assertEqual(self.process("one.c", '#include "a.h"\n'), "int a ;")
+        self.assertEqual(self.process("two.c", '#include "a.h"\nint b;\n'),
+                         "int a ; int b ;")
+        self.assertEqual(lexed.count(os.path.realpath(path)), 1)
+
+        # A changed header is lexed again.
+        self.write("a.h", "int c;\n")
+        os.utime(path, ns=(0, 0))
+        self.assertEqual(self.process("three.c", '#include "a.h"\n'),
+                         "int c ;")
+        self.assertEqual(lexed.count(os.path.realpath(path)), 2)
+
+    def test_ifdef_nesting(self):
+        """Nested #ifdef and #else branches are taken or skipped."""
+        text = ("#define A\n"
+                "#ifdef A\n"
+                "  #ifdef B\n"
+                "    int ab;\n"
+                "  #else\n"
+                "    int a;\n"
+                "    #ifndef B\n"
+                "      int not_b;\n"
+                "    #endif\n"
+                "  #endif\n"
+                "#else\n"
+                "  #ifdef A\n"
+                "    int never;\n"
+                "  #else\n"
+                "    int never_else;\n"
+                "  #endif\n"
+                "#endif\n"
+                "int end;\n")
+        self.assertEqual(self.process("main.c", text),
+                         "int a ; int not_b ; int end ;")
+
+
+if __name__ == "__main__":
+    unittest.main()